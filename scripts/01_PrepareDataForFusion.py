@@ -25,8 +25,14 @@ import shutil
 import pdal
 import json
 import time
-from joblib import Parallel, delayed
 import subprocess
+from lidarFunctions import (
+    runGoverned,
+    estimateReprojectMemory,
+    selectPreviewFiles,
+    createThinningStage,
+)
+from pdalWorkerService import startService, submitJobs, reprojectJob
 
 
 # -----------------------------------------------------------------------------
@@ -50,13 +56,42 @@ dirFUSION = r"C:\Fusion"
 # Maximum number of processing cores
 nCoresMax = 26
 
+# Memory (GB) the parallel PDAL and FUSION jobs may use together
+# None uses 80% of the RAM that is free when the jobs start
+memBudget = None
+
+# Run the PDAL jobs in pdalWorkerService.py, which keeps PDAL and PROJ loaded
+# between runs. The service is started (with nCoresMax, memBudget, and the
+# Catalog.exe in dirFUSION) if it is not running and keeps running after this
+# script ends.
+useWorkerService = False
+
+# Preview mode reprojects a thinned sample of the lidar files so settings
+# (HTCUTOFF, COVERCUTOFF, STRATAHEIGHTS, dictSRS) can be checked in minutes.
+# Outputs are saved to <project>_PREVIEW; use that project name in 02 and 03.
+previewMode = False
+
+# The extent is split into previewGrid x previewGrid cells and
+# previewFilesPerCell files are used from each cell
+previewGrid = 4
+previewFilesPerCell = 1
+
+# "decimation" keeps every previewStep-th point; "voxel" keeps one point per
+# previewVoxelSize voxel (units of the original SRS)
+previewThinning = "decimation"
+previewStep = 10
+previewVoxelSize = 1.0
+
 # main output directory
 dirBase = r"D:\LidarProcessing"
 if not os.path.exists(dirBase):
     os.mkdir(dirBase)
 
 # directory for the specific lidar project; HOME_FOLDER in FUSION scripts
-dirHomeFolder = os.path.join(dirBase, project)
+if previewMode:
+    dirHomeFolder = os.path.join(dirBase, project + "_PREVIEW")
+else:
+    dirHomeFolder = os.path.join(dirBase, project)
 if not os.path.exists(dirHomeFolder):
     os.mkdir(dirHomeFolder)
 
@@ -97,8 +132,9 @@ dictSRS = {
 # -----------------------------------------------------------------------------
 
 # "parallel" functions are used with joblib
-def parallelProjectFunc(lidarFile, dirLidarCopy, dirLAZ5070, srsIn):
+def parallelProjectFunc(lidarFile, dirLidarCopy, dirLAZ5070, srsIn, thinStage=None):
     # Function used to project the laz files to EPSG 5070
+    # thinStage (dict) - optional PDAL stage that thins the points (preview mode)
 
     # File name of projected LAZ file
     lasfile5070 = os.path.join(dirLAZ5070, lidarFile[:-4] + ".laz")
@@ -146,6 +182,9 @@ def parallelProjectFunc(lidarFile, dirLidarCopy, dirLAZ5070, srsIn):
                 "filename": lasfile5070,
             },
         ]
+    # thin the points before they are reprojected
+    if thinStage is not None:
+        reprojectPipeline.insert(1, thinStage)
     pipeline = pdal.Pipeline(json.dumps(reprojectPipeline))
     try:
         pipeline.execute()
@@ -162,19 +201,6 @@ def parallelProjectFunc(lidarFile, dirLidarCopy, dirLAZ5070, srsIn):
     time.sleep(0.01)
 
 
-def calcNCores(x, nCoresMax):
-    # Calculates the number of cores that should be dedicated to parallel processes
-    # x (list) object whose length will be compared
-    # nCoresMax (int) - maximum number of processing cores available
-    if nCoresMax > len(x):
-        nCores = len(x)
-    else:
-        nCores = nCoresMax
-    if nCores < 1:
-        nCores = 1
-    return int(nCores)
-
-
 # -----------------------------------------------------------------------------
 # -----------------------------------------------------------------------------
 # Processing
@@ -185,6 +211,15 @@ def calcNCores(x, nCoresMax):
 lidarFilesOriginal = os.listdir(dirLidarOriginal)
 lidarFilesOriginal.sort()
 
+# Preview runs only use a sample of the files and points
+thinStage = None
+if previewMode:
+    lidarFilesOriginal = selectPreviewFiles(
+        dirLidarOriginal, lidarFilesOriginal, previewGrid, previewFilesPerCell
+    )
+    thinStage = createThinningStage(previewThinning, previewStep, previewVoxelSize)
+    print("\tPreview using " + str(len(lidarFilesOriginal)) + " files")
+
 
 # ----------------------------------------------------------------------------
 # Process Point Data
@@ -224,12 +259,37 @@ if not os.path.exists(dirLAZ5070):
 lidarFilesCopy = os.listdir(dirLidarCopy)
 lidarFilesCopy.sort()
 
-nCores = calcNCores(lidarFilesCopy, nCoresMax)
-Parallel(n_jobs=nCores)(
-    delayed(parallelProjectFunc)(lidarFile, dirLidarCopy, dirLAZ5070, srsIn)
-    for lidarFile in lidarFilesCopy
-)
-del nCores
+if useWorkerService:
+    startService(nCoresMax, memBudget, os.path.join(dirFUSION, "Catalog.exe"))
+    results = submitJobs(
+        [
+            reprojectJob(
+                os.path.join(dirLidarCopy, lidarFile),
+                dirLAZ5070,
+                srsIn,
+                thinStage,
+                estimateReprojectMemory(os.path.join(dirLidarCopy, lidarFile)),
+            )
+            for lidarFile in lidarFilesCopy
+        ]
+    )
+    for lidarFile, result in zip(lidarFilesCopy, results):
+        if result["error"] is not None:
+            print("\t" + lidarFile + ": " + result["error"])
+else:
+    runGoverned(
+        parallelProjectFunc,
+        argsList=[
+            (lidarFile, dirLidarCopy, dirLAZ5070, srsIn, thinStage)
+            for lidarFile in lidarFilesCopy
+        ],
+        memEstimates=[
+            estimateReprojectMemory(os.path.join(dirLidarCopy, lidarFile))
+            for lidarFile in lidarFilesCopy
+        ],
+        nCoresMax=nCoresMax,
+        memBudget=memBudget,
+    )
 del lidarFilesCopy
 
 # remove the copy of Lidar files
@@ -24,7 +24,8 @@ import time
 import rasterio as rio
 
 # from rasterio.plot import show
-import numpy as np
+from lidarFunctions import cleanGrids, createTileManifest, writeTileManifest
+from topoMetrics import computeTopoMetrics, calculateLatitude
 
 # -----------------------------------------------------------------------------
 # -----------------------------------------------------------------------------
@@ -45,40 +46,23 @@ dirFinalProducts = r"G:\FusionRuns"
 if not os.path.exists(dirFinalProducts):
     os.mkdir(dirFinalProducts)
 
+# Compute the topographic metrics in Python instead of FUSION
+# Set DOTOPO=FALSE in Basic_setup.bat when this is True
+useNativeTopo = False
 
-# -----------------------------------------------------------------------------
-# -----------------------------------------------------------------------------
-# Define Functions
-# -----------------------------------------------------------------------------
-# -----------------------------------------------------------------------------
-def cleanGrids(inFiles, outDir, fpElev):
-    # Read in Elevation Raster
-    with rio.open(fpElev) as src:
-        rasElev = src.read()
-        kwds = src.profile
-
-    for inFile in inFiles:
-        # Read in raster to be processed
-        with rio.open(inFile) as src:
-            rasMetric = src.read()
-        # name of the metric
-        metric = os.path.basename(inFile)
+# Window sizes of the topographic metrics (MULTITOPOWINDOWSIZES and
+# MULTITPIWINDOWSIZES in Basic_setup.bat)
+topoWindowSizes = [15, 45, 135, 270]
+tpiWindowSizes = [200, 500, 1000, 2000, 4000]
 
-        rasCleanMetric = np.empty(
-            rasElev.shape, dtype=rio.float32
-        )  # Create empty matrix
-        check = np.logical_and(
-            rasMetric == -9999, rasElev != -9999
-        )  # Create check raster with True/False values
-        rasCleanMetric = np.where(check, 0, rasMetric)
+# Maximum number of processing cores
+nCoresMax = 26
 
-        # Save
-        if not os.path.exists(outDir):
-            os.mkdir(outDir)
-
-        fpCleanMetric = os.path.join(outDir, metric)
-        with rio.open(fpCleanMetric, "w", **kwds) as dst:
-            dst.write(rasCleanMetric)
+# Cell size of the FUSION metrics; used in the product folder names
+# Preview projects (previewMode in 01_PrepareDataForFusion.py) use 90 m cells
+fileIdentifier = "30METERS"
+if project.endswith("_PREVIEW"):
+    fileIdentifier = "90METERS"
 
 
 # -----------------------------------------------------------------------------
@@ -104,6 +88,15 @@ if not os.path.exists(os.path.join(dirFusionProducts, "complete.txt")):
     while not os.path.exists(os.path.join(dirFusionProducts, "complete.txt")):
         time.sleep(60)
 
+# Record the lidar files used by FUSION; also when 03 is rerun or the blocks
+# were run by 05_RunBlocksOnCluster.py
+# 04_UpdateChangedTiles.py compares against this to find redelivered tiles and
+# updates it, so an existing manifest is not replaced here
+fpManifest = os.path.join(dirFusionProcessingAP, "TileManifest.csv")
+if not os.path.exists(fpManifest):
+    dirLAZ5070 = os.path.join(dirHomeFolder, "Points", "LAZ5070")
+    writeTileManifest(createTileManifest(dirLAZ5070), fpManifest)
+
 # -----------------------------------------------------------------------------
 # -----------------------------------------------------------------------------
 # Copy Products
@@ -117,8 +110,44 @@ if not os.path.exists(dirOutProject):
 
 
 # Directory of FUSION Metrics
-dirFusionMetrics = os.path.join(dirFusionProducts, "Metrics_30METERS")
-fpElev = os.path.join(dirFusionMetrics, "TOPO_elevation_30METERS.asc")
+dirFusionMetrics = os.path.join(dirFusionProducts, "Metrics_" + fileIdentifier)
+fpElev = os.path.join(dirFusionMetrics, "TOPO_elevation_" + fileIdentifier + ".asc")
+
+# Native topographic metrics from the ground DTMs
+if useNativeTopo:
+    print("Computing topographic metrics")
+    dirGround = os.path.join(dirFusionProducts, "BareGround_1METERS")
+    fpDtms = [
+        os.path.join(dirGround, e)
+        for e in sorted(os.listdir(dirGround))
+        if e.endswith("_TRIMMED.asc")
+    ]
+    # line the topo grids up with the FUSION metrics
+    fpTemplate = [
+        os.path.join(dirFusionMetrics, e)
+        for e in sorted(os.listdir(dirFusionMetrics))
+        if e.endswith(".asc") and not e.startswith("TOPO_")
+    ][0]
+    with rio.open(fpTemplate) as src:
+        gridTransform = src.transform
+        gridWidth = src.width
+        gridHeight = src.height
+        gridBounds = src.bounds
+    latitude = calculateLatitude(
+        xMid=(gridBounds.left + gridBounds.right) / 2,
+        yMid=(gridBounds.bottom + gridBounds.top) / 2,
+    )
+    computeTopoMetrics(
+        fpDtms=fpDtms,
+        outDir=dirFusionMetrics,
+        gridTransform=gridTransform,
+        gridWidth=gridWidth,
+        gridHeight=gridHeight,
+        windowSizes=topoWindowSizes,
+        tpiWindowSizes=tpiWindowSizes,
+        latitude=latitude,
+        nCores=nCoresMax,
+    )
 
 
 dirOutMetrics = os.path.join(dirOutProject, "FusionOutputs")
@@ -167,7 +196,7 @@ cleanGrids(
 # Canopy Metrics
 # -----------------------------------------------------------------------------
 
-dirFusionCanopyMetrics = os.path.join(dirFusionProducts, "CanopyMetrics_30METERS")
+dirFusionCanopyMetrics = os.path.join(dirFusionProducts, "CanopyMetrics_" + fileIdentifier)
 
 rasters = []
 for i in os.listdir(dirFusionCanopyMetrics):
@@ -188,7 +217,7 @@ cleanGrids(
 # Strata Metrics
 # -----------------------------------------------------------------------------
 
-dirFusionStrataMetrics = os.path.join(dirFusionProducts, "StrataMetrics_30METERS")
+dirFusionStrataMetrics = os.path.join(dirFusionProducts, "StrataMetrics_" + fileIdentifier)
 
 rasters = []
 for i in os.listdir(dirFusionStrataMetrics):
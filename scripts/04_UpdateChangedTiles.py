@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+Name:    04_UpdateChangedTiles.py
+Purpose: Reprocesses only the FUSION blocks affected by redelivered lidar tiles
+Author:  PA Fekety, Colorado State University, patrick.fekety@colostate.edu
+Date:    2021.03.02
+
+"""
+
+"""
+Notes:
+  Use this after a project has been run with 01, 02, AreaProcessor, and 03.
+  03_CreateGriddedMetrics.py (or 05_RunBlocksOnCluster.py) writes
+    Processing\AP\TileManifest.csv when FUSION finishes. The manifest records the size, modified time, and header extent
+    of each LAZ5070 file.
+  Put the redelivered files (already projected to EPSG:5070) in LAZ5070, then
+    run this script. Changed, added, and removed files are found by comparing
+    LAZ5070 to the manifest. Their extents plus the PRP BufferWidth are
+    intersected with the ProcessingBlocks in the PRP.
+  Only the dirty tiles of the dirty blocks are rerun, only the layers those
+    blocks rewrote are merged, and only the dirty block windows are cleaned.
+  Added files must be inside the processing extent in the PRP and listed in
+    the AreaProcessor file list. If not, rerun 02 and recreate the scripts.
+"""
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Import packages
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+import os
+import shutil
+import subprocess
+import time
+from lidarFunctions import (
+    createTileManifest,
+    readTileManifest,
+    writeTileManifest,
+    findChangedExtents,
+    readPRP,
+    getPRPBlocks,
+    getPRPProjection,
+    findDirtyBlocks,
+    findBlockScripts,
+    filterBlockScript,
+    mergeBlockLayer,
+    cleanGrids,
+)
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Assign Variables
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+start = time.time()
+
+# Assign a project
+project = "CO_ARRA_ParkCo_2010"
+print(project)
+
+# FUSION directory
+dirFUSION = r"C:\Fusion"
+
+# main output directory
+dirBase = r"D:\LidarProcessing"
+
+# directory where the final products were saved by 03_CreateGriddedMetrics.py
+dirFinalProducts = r"G:\FusionRuns"
+
+# Cell size of the FUSION metrics; used in the product folder names
+fileIdentifier = "30METERS"
+
+# Cell size of the canopy height models; used in the product folder names
+canopyFileIdentifier = "1p0METERS"
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Define Functions
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+def cleanedMetricDir(layerDir, layer):
+    # Folder under FusionOutputs used by 03_CreateGriddedMetrics.py
+    if layerDir.startswith("Metrics_"):
+        if layer.startswith("TOPO_"):
+            return "TopoMetrics"
+        if "_int_" in layer:
+            return "IntensityMetrics"
+        return "HeightMetrics"
+    if layerDir.startswith("TopoMetrics_"):
+        return "TopoMetrics"
+    if layerDir.startswith("CanopyMetrics_"):
+        return "CanopyMetrics"
+    if layerDir.startswith("StrataMetrics_"):
+        return "StrataMetrics"
+    return None
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Find Dirty Blocks
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# directory for the specific lidar project; HOME_FOLDER in FUSION scripts
+dirHomeFolder = os.path.join(dirBase, project)
+dirLAZ5070 = os.path.join(dirHomeFolder, "Points", "LAZ5070")
+dirFusionProducts = os.path.join(dirHomeFolder, "Products")
+dirFusionProductsBlocks = os.path.join(dirFusionProducts, "Products_Blocks")
+dirFusionProcessingAP = os.path.join(dirHomeFolder, "Processing", "AP")
+fpManifest = os.path.join(dirFusionProcessingAP, "TileManifest.csv")
+fpPRP = os.path.join(dirHomeFolder, "PRP", project + "_APSetup.prp")
+
+if not os.path.exists(fpManifest):
+    raise FileNotFoundError(
+        fpManifest + " does not exist. Run 03_CreateGriddedMetrics.py first."
+    )
+
+print("\tComparing LAZ5070 to the tile manifest")
+manifestOld = readTileManifest(fpManifest)
+manifestNew = createTileManifest(dirLAZ5070)
+changedFiles = findChangedExtents(manifestOld, manifestNew)
+
+if len(changedFiles) == 0:
+    print("\tNo lidar files have changed")
+    raise SystemExit
+
+changedExtents = []
+for lidarFile in sorted(changedFiles):
+    print("\t\t" + lidarFile)
+    changedExtents.extend(changedFiles[lidarFile])
+
+prp = readPRP(fpPRP)
+buffer = float(prp["ProcessingOptions"]["BufferWidth"])
+blocks = getPRPBlocks(prp)
+dirtyBlocks = findDirtyBlocks(blocks, changedExtents, buffer)
+print(
+    "\t"
+    + str(len(dirtyBlocks))
+    + " of "
+    + str(len(blocks))
+    + " blocks need to be reprocessed"
+)
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Rerun Dirty Blocks
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+blockScripts = findBlockScripts(dirFusionProcessingAP)
+startBlocks = time.time()
+
+for block in dirtyBlocks:
+    blockName = block["blockName"].upper()
+    if blockName not in blockScripts:
+        print("\tNo processing script found for " + blockName)
+        continue
+    fpBlockScript = blockScripts[blockName]
+    fpDirtyScript = fpBlockScript[:-4] + "_dirty.bat"
+    dirtyTiles = filterBlockScript(fpBlockScript, fpDirtyScript, changedExtents, buffer)
+    print("\tRunning " + blockName + " (" + str(len(dirtyTiles)) + " tiles)")
+    subprocess.run('"' + fpDirtyScript + '"', shell=True, cwd=dirFusionProcessingAP)
+    os.remove(fpDirtyScript)
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Merge Touched Layers
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# A layer is touched if any dirty block rewrote it. The merge still uses the
+# layer from every block so the merged layer covers the whole project.
+touchedLayers = set()
+for block in dirtyBlocks:
+    dirBlock = os.path.join(dirFusionProductsBlocks, block["blockName"])
+    if not os.path.exists(dirBlock):
+        continue
+    for layerDir in os.listdir(dirBlock):
+        if cleanedMetricDir(layerDir, "") is None:
+            continue
+        for layer in os.listdir(os.path.join(dirBlock, layerDir)):
+            if not layer.endswith(".asc"):
+                continue
+            fpLayer = os.path.join(dirBlock, layerDir, layer)
+            if os.path.getmtime(fpLayer) >= startBlocks:
+                touchedLayers.add((layerDir, layer))
+
+print("\tMerging " + str(len(touchedLayers)) + " layers")
+for layerDir, layer in sorted(touchedLayers):
+    mergeBlockLayer(
+        layer,
+        layerDir,
+        dirFusionProductsBlocks,
+        dirFusionProducts,
+        dirFUSION,
+        getPRPProjection(prp),
+    )
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Clean Dirty Windows
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+dirOutMetrics = os.path.join(dirFinalProducts, project, "FusionOutputs")
+fpElev = os.path.join(
+    dirFusionProducts, "Metrics_" + fileIdentifier, "TOPO_elevation_" + fileIdentifier + ".asc"
+)
+blockExtents = [
+    (block["minX"], block["minY"], block["maxX"], block["maxY"]) for block in dirtyBlocks
+]
+
+print("\tCleaning dirty windows")
+for layerDir, layer in sorted(touchedLayers):
+    outDir = os.path.join(dirOutMetrics, cleanedMetricDir(layerDir, layer))
+    cleanGrids(
+        inFiles=[os.path.join(dirFusionProducts, layerDir, layer)],
+        outDir=outDir,
+        fpElev=fpElev,
+        extents=blockExtents,
+    )
+
+# Canopy height models are not merged (MERGEBLOCKCANOPY=FALSE); postblock.bat
+# moves them to the final products folder with the block name as a prefix
+dirCHM = os.path.join(dirFusionProducts, "CanopyHeight_" + canopyFileIdentifier)
+dirDestination = os.path.join(dirOutMetrics, "CHM")
+if os.path.exists(dirCHM) and os.path.exists(dirDestination):
+    for block in dirtyBlocks:
+        for raster in os.listdir(dirCHM):
+            if not raster.startswith(block["blockName"] + "_"):
+                continue
+            if raster.endswith(".asc") or raster.endswith(".prj"):
+                shutil.copy(
+                    src=os.path.join(dirCHM, raster),
+                    dst=os.path.join(dirDestination, raster),
+                )
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Update the Manifest
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+writeTileManifest(manifestNew, fpManifest)
+
+stop = time.time()
+print(str((stop - start) / 60) + "  minutes")
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Name:    05_RunBlocksOnCluster.py
+Purpose: Runs the FUSION processing blocks on several computers
+Author:  PA Fekety, Colorado State University, patrick.fekety@colostate.edu
+Date:    2021.03.16
+
+"""
+
+"""
+Notes:
+  Use this instead of running APFusion.bat when a project is too big for one
+    computer. Run it after creating the AreaProcessor scripts, then run
+    03_CreateGriddedMetrics.py as usual (complete.txt is written here, so 03
+    does not run APFusion.bat again).
+  In "cluster" mode, start blockCluster.py on each worker after this script
+    prints the address. In "local" mode the workers are processes on this
+    computer, which is useful for testing.
+  The layers are merged across blocks on this computer after all blocks
+    finish, the same way postblock.bat does, and get the projection file of
+    the PRP. complete.txt is not written if a block or a merge failed.
+"""
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Import packages
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+import os
+import csv
+import time
+from multiprocessing.connection import Listener
+from lidarFunctions import (
+    readPRP,
+    getPRPProjection,
+    findBlockScripts,
+    mergeBlockLayer,
+    createTileManifest,
+    writeTileManifest,
+)
+from blockCluster import createBlockJobs, runCoordinator, runLocalCluster
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Assign Variables
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+start = time.time()
+
+# Assign a project
+project = "CO_ARRA_ParkCo_2010"
+print(project)
+
+# FUSION directory
+dirFUSION = r"C:\Fusion"
+
+# main output directory; must be on a file system shared with the workers
+dirBase = r"D:\LidarProcessing"
+
+# "local" runs the workers on this computer; "cluster" waits for workers
+clusterMode = "local"
+
+# Number of workers in "local" mode
+nLocalWorkers = 4
+
+# Address the workers connect to in "cluster" mode
+coordinatorAddress = ("0.0.0.0", 50505)
+
+# Shared secret of the coordinator and the workers
+authkey = b"change me"
+
+# Command each worker runs for a block; {script} is the block batch file
+commandTemplate = "{script}"
+
+# Seconds without a heartbeat before a worker is considered lost
+leaseTimeout = 120
+
+# Number of times a block is tried when workers are lost
+maxAttempts = 3
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Run Blocks
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+    dirHomeFolder = os.path.join(dirBase, project)
+    dirFusionProducts = os.path.join(dirHomeFolder, "Products")
+    dirFusionProductsBlocks = os.path.join(dirFusionProducts, "Products_Blocks")
+    dirFusionProcessingAP = os.path.join(dirHomeFolder, "Processing", "AP")
+    fpPRP = os.path.join(dirHomeFolder, "PRP", project + "_APSetup.prp")
+    fpBasePrj = getPRPProjection(readPRP(fpPRP))
+
+    blockScripts = findBlockScripts(dirFusionProcessingAP)
+    jobs = createBlockJobs(blockScripts, commandTemplate, cwd=dirFusionProcessingAP)
+    print("\t" + str(len(jobs)) + " blocks")
+
+    if clusterMode == "local":
+        results = runLocalCluster(jobs, nLocalWorkers, leaseTimeout, maxAttempts)
+    else:
+        listener = Listener(coordinatorAddress, authkey=authkey)
+        print("\tWaiting for workers on port " + str(coordinatorAddress[1]))
+        try:
+            results = runCoordinator(jobs, listener, leaseTimeout, maxAttempts)
+        finally:
+            listener.close()
+
+    # Log of each block
+    dirLogs = os.path.join(dirFusionProducts, "Logs")
+    if not os.path.exists(dirLogs):
+        os.makedirs(dirLogs)
+    with open(os.path.join(dirLogs, "ClusterBlocks.csv"), "w", newline="") as f:
+        writer = csv.DictWriter(
+            f,
+            fieldnames=["jobID", "worker", "returncode", "seconds", "attempts", "stderr"],
+        )
+        writer.writeheader()
+        for result in results:
+            writer.writerow(result)
+
+    failed = [r["jobID"] for r in results if r["returncode"] != 0]
+    if len(failed) > 0:
+        print("\nErrors Exist")
+        print("\tBlocks that failed: " + ", ".join(failed))
+        raise SystemExit
+
+    # -------------------------------------------------------------------------
+    # Merge Layers
+    # -------------------------------------------------------------------------
+    print("\tMerging layers")
+    layers = set()
+    for blockName in os.listdir(dirFusionProductsBlocks):
+        dirBlock = os.path.join(dirFusionProductsBlocks, blockName)
+        if not os.path.isdir(dirBlock):
+            continue
+        for layerDir in os.listdir(dirBlock):
+            if not layerDir.startswith(
+                ("Metrics_", "StrataMetrics_", "CanopyMetrics_", "TopoMetrics_")
+            ):
+                continue
+            for layer in os.listdir(os.path.join(dirBlock, layerDir)):
+                if layer.endswith(".asc"):
+                    layers.add((layerDir, layer))
+
+    failed = []
+    for layerDir, layer in sorted(layers):
+        try:
+            mergeBlockLayer(
+                layer,
+                layerDir,
+                dirFusionProductsBlocks,
+                dirFusionProducts,
+                dirFUSION,
+                fpBasePrj,
+            )
+        except (RuntimeError, OSError) as err:
+            print("\t" + str(err))
+            failed.append(layer)
+    if len(failed) > 0:
+        print("\nErrors Exist")
+        print("\tLayers that were not merged: " + ", ".join(failed))
+        raise SystemExit
+
+    # Record the lidar files used by this run for 04_UpdateChangedTiles.py
+    writeTileManifest(
+        createTileManifest(os.path.join(dirHomeFolder, "Points", "LAZ5070")),
+        os.path.join(dirFusionProcessingAP, "TileManifest.csv"),
+    )
+
+    with open(os.path.join(dirFusionProducts, "complete.txt"), "w") as f:
+        f.write("completed " + time.strftime("%Y%m%d"))
+        f.write("\n")
+
+    stop = time.time()
+    print(str((stop - start) / 60) + "  minutes")
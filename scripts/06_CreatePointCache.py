@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Name:    06_CreatePointCache.py
+Purpose: Creates the height-normalized point cache of each processing block
+Author:  PA Fekety, Colorado State University, patrick.fekety@colostate.edu
+Date:    2021.03.30
+
+"""
+
+"""
+Notes:
+  Run this after the ground models exist (after FUSION has run, or with the
+    vendor ground models in Deliverables\DTM).
+  The tiles are the ProcessingBlocks in the PRP, buffered by BufferWidth, so
+    the cache covers the same points FUSION uses for each block.
+  Noise classes, outliers, and ground are handled with the same values as
+    CLASSOPTION, OUTLIER, and DTMSPEC in Basic_setup.bat. Keep them the same.
+  Blocks whose cache is newer than their lidar files and the ground models
+    that overlap the block are skipped, so this can be rerun after
+    04_UpdateChangedTiles.py.
+  The cache is read with pointCache.readTileCache() by 08_CreateCellMetrics.py.
+    FUSION (tile.bat) does not read it, so this is an extra pass over the
+    lidar files; skip it if only the FUSION products are needed.
+"""
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Import packages
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+import os
+import time
+from lidarFunctions import (
+    listLidarFiles,
+    readPRP,
+    getPRPBlocks,
+    bufferExtent,
+    runGoverned,
+)
+from pointCache import findTileFiles, buildTileCache, estimateCacheMemory
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Assign Variables
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+start = time.time()
+
+# Assign a project
+project = "CO_ARRA_ParkCo_2010"
+print(project)
+
+# main output directory
+dirBase = r"D:\LidarProcessing"
+
+# Directory of the ground models (DTMSPEC); None uses the ground models
+# created by FUSION (Products\BareGround_1METERS)
+dirGround = None
+
+# Classes that are dropped (CLASSOPTION=/class:~7,9)
+excludeClasses = (7, 9)
+
+# Heights outside this range are dropped (OUTLIER=-30,150)
+outlier = (-30, 150)
+
+# Buffer around each block; None uses BufferWidth from the PRP
+# 08_CreateCellMetrics.py needs at least its largest cell size
+bufferWidth = None
+
+# Maximum number of processing cores
+nCoresMax = 26
+
+# GB of memory the blocks may use at once; None uses 80% of the free memory
+memBudget = None
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Create Point Cache
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+    # directory for the specific lidar project; HOME_FOLDER in FUSION scripts
+    dirHomeFolder = os.path.join(dirBase, project)
+    dirLAZ5070 = os.path.join(dirHomeFolder, "Points", "LAZ5070")
+    dirFusionProducts = os.path.join(dirHomeFolder, "Products")
+    dirPointCache = os.path.join(dirFusionProducts, "PointCache")
+    fpPRP = os.path.join(dirHomeFolder, "PRP", project + "_APSetup.prp")
+    if dirGround is None:
+        dirGround = os.path.join(dirFusionProducts, "BareGround_1METERS")
+
+    fpDtms = [
+        os.path.join(dirGround, f)
+        for f in sorted(os.listdir(dirGround))
+        if f.lower().endswith((".dtm", ".tif", ".img", ".asc"))
+    ]
+    # FUSION writes the same ground as .dtm and .asc; use one of them
+    if any(fp.lower().endswith(".dtm") for fp in fpDtms):
+        fpDtms = [fp for fp in fpDtms if fp.lower().endswith(".dtm")]
+    if len(fpDtms) == 0:
+        raise FileNotFoundError("No ground models in " + dirGround)
+
+    fpLidars = [os.path.join(dirLAZ5070, f) for f in listLidarFiles(dirLAZ5070)]
+
+    prp = readPRP(fpPRP)
+    buffer = float(prp["ProcessingOptions"]["BufferWidth"])
+    if bufferWidth is not None:
+        buffer = bufferWidth
+    blocks = getPRPBlocks(prp)
+
+    argsList = []
+    memEstimates = []
+    for block in blocks:
+        bufferedExtent = bufferExtent(
+            (block["minX"], block["minY"], block["maxX"], block["maxY"]), buffer
+        )
+        tileFiles = findTileFiles(fpLidars, bufferedExtent)
+        if len(tileFiles) == 0:
+            continue
+        argsList.append(
+            (
+                block["blockName"],
+                bufferedExtent,
+                tileFiles,
+                fpDtms,
+                dirPointCache,
+                excludeClasses,
+                outlier,
+            )
+        )
+        memEstimates.append(estimateCacheMemory(tileFiles))
+
+    print("\tCaching " + str(len(argsList)) + " blocks")
+    if not os.path.exists(dirPointCache):
+        os.makedirs(dirPointCache)
+    nPoints = runGoverned(
+        buildTileCache, argsList, memEstimates, nCoresMax, memBudget=memBudget
+    )
+    print("\t" + str(sum(nPoints)) + " points cached")
+
+    stop = time.time()
+    print(str((stop - start) / 60) + "  minutes")
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Name:    07_BuildProductMosaic.py
+Purpose: Mosaics the published products of all projects, one layer per metric
+Author:  PA Fekety, Colorado State University, patrick.fekety@colostate.edu
+Date:    2021.04.13
+
+"""
+
+"""
+Notes:
+  Run this after 03_CreateGriddedMetrics.py has published the projects to
+    dirFinalProducts. Rerun it when a project is added or republished.
+  ProductCatalog.csv lists every published raster. A VRT is written for each
+    metric; the project files are not copied or merged.
+  Set writeCOG to True to also write each metric as a Cloud Optimized
+    GeoTIFF. This reads every project, so it takes much longer.
+"""
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Import packages
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+import os
+import time
+from productCatalog import (
+    buildProductCatalog,
+    writeProductCatalog,
+    selectMetric,
+    writeMosaicVRT,
+    writeMosaicCOG,
+)
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Assign Variables
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+start = time.time()
+
+# directory where the final products were saved by 03_CreateGriddedMetrics.py
+dirFinalProducts = r"G:\FusionRuns"
+
+# directory of the mosaics
+dirMosaic = r"G:\FusionMosaics"
+
+# Project used where projects overlap: "newest", "oldest", or a list of
+# project names with the highest priority first
+priority = "newest"
+
+# Metrics to mosaic (e.g., ["elev_P95_2plus_30METERS"]); None mosaics all
+metrics = None
+
+# Also write a Cloud Optimized GeoTIFF of each metric
+writeCOG = False
+
+# Maximum number of processing cores
+nCoresMax = 26
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Build Mosaics
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+if not os.path.exists(dirMosaic):
+    os.makedirs(dirMosaic)
+
+print("Cataloging " + dirFinalProducts)
+catalog = buildProductCatalog(dirFinalProducts, nCores=nCoresMax)
+writeProductCatalog(catalog, os.path.join(dirMosaic, "ProductCatalog.csv"))
+print("\t" + str(len(set(row["project"] for row in catalog))) + " projects")
+
+if metrics is None:
+    metrics = sorted(set(row["metric"] for row in catalog))
+
+for metric in metrics:
+    print("\t" + metric)
+    rows = selectMetric(catalog, metric, priority)
+    writeMosaicVRT(rows, os.path.join(dirMosaic, metric + ".vrt"))
+    if writeCOG:
+        writeMosaicCOG(rows, os.path.join(dirMosaic, metric + ".tif"), nCores=nCoresMax)
+
+stop = time.time()
+print(str((stop - start) / 60) + "  minutes")
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Name:    08_CreateCellMetrics.py
+Purpose: Creates height metrics at several cell sizes from one pass over the
+         point cache
+Author:  PA Fekety, Colorado State University, patrick.fekety@colostate.edu
+Date:    2021.04.20
+
+"""
+
+"""
+Notes:
+  Run 06_CreatePointCache.py first, with bufferWidth at least the largest
+    cell size.
+  Each block is summarized at the smallest cell size and the summary is
+    saved in Products\CellSummaries. Every cell size is made from the
+    summary, so adding a cell size later does not read the points again; set
+    reuseSummaries to True. This only works if the smallest cell size is the
+    same and the new cell size divides the least common multiple of the
+    cell sizes of the summary (e.g., 10 m from a 30 m and 90 m run, but not
+    20 m); otherwise writeCellMetrics() raises an error and the points must
+    be summarized again with reuseSummaries set to False.
+  The block layers are written to Products_Blocks\BLOCKn\CellMetrics_<size>
+    and merged to Products\CellMetrics_<size>.
+"""
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Import packages
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+import os
+import time
+from lidarFunctions import (
+    readPRP,
+    getPRPBlocks,
+    getPRPProjection,
+    runGoverned,
+    mergeBlockLayer,
+)
+from cellStatistics import (
+    processBlock,
+    estimateSummaryMemory,
+    loadSummary,
+    writeCellMetrics,
+)
+from topoMetrics import formatIdentifier
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Assign Variables
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+start = time.time()
+
+# Assign a project
+project = "CO_ARRA_ParkCo_2010"
+print(project)
+
+# FUSION directory
+dirFUSION = r"C:\Fusion"
+
+# main output directory
+dirBase = r"D:\LidarProcessing"
+
+# Cell sizes of the metrics; each must be a multiple of the smallest
+cellSizes = [10, 30, 90]
+
+# Same as HTCUTOFF, COVERCUTOFF, and STRATAHEIGHTS in Basic_setup.bat
+htCutoff = 2
+coverCutoff = 2
+strataHeights = [0.5, 1, 2, 4, 8, 16, 32, 48, 64]
+
+# Width (m) of the height histogram bins used for the percentiles
+binWidth = 0.5
+
+# Make the metrics from saved summaries instead of the point cache
+reuseSummaries = False
+
+# Maximum number of processing cores
+nCoresMax = 26
+
+# GB of memory the blocks may use at once; None uses 80% of the free memory
+memBudget = None
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Define Functions
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+def parallelWriteFunc(fpSummary, cellSizes, dirBlock):
+    # Writes the metrics of a saved summary
+    writeCellMetrics(loadSummary(fpSummary), cellSizes, dirBlock)
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Create Metrics
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+    dirHomeFolder = os.path.join(dirBase, project)
+    dirFusionProducts = os.path.join(dirHomeFolder, "Products")
+    dirFusionProductsBlocks = os.path.join(dirFusionProducts, "Products_Blocks")
+    dirPointCache = os.path.join(dirFusionProducts, "PointCache")
+    dirSummaries = os.path.join(dirFusionProducts, "CellSummaries")
+    fpPRP = os.path.join(dirHomeFolder, "PRP", project + "_APSetup.prp")
+    prp = readPRP(fpPRP)
+    if not os.path.exists(dirSummaries):
+        os.makedirs(dirSummaries)
+
+    options = {
+        "htCutoff": htCutoff,
+        "coverCutoff": coverCutoff,
+        "strataHeights": strataHeights,
+        "binWidth": binWidth,
+    }
+    argsList = []
+    memEstimates = []
+    for block in getPRPBlocks(prp):
+        blockName = block["blockName"]
+        dirTile = os.path.join(dirPointCache, blockName)
+        fpSummary = os.path.join(dirSummaries, blockName + ".npz")
+        dirBlock = os.path.join(dirFusionProductsBlocks, blockName)
+        extent = (block["minX"], block["minY"], block["maxX"], block["maxY"])
+        if reuseSummaries:
+            if not os.path.exists(fpSummary):
+                continue
+            argsList.append((fpSummary, cellSizes, dirBlock))
+            memEstimates.append(os.path.getsize(fpSummary) * 4)
+        else:
+            if not os.path.exists(os.path.join(dirTile, "tile.json")):
+                continue
+            argsList.append((dirTile, extent, cellSizes, fpSummary, dirBlock, options))
+            memEstimates.append(
+                estimateSummaryMemory(dirTile, extent, cellSizes, binWidth)
+            )
+
+    print("\t" + str(len(argsList)) + " blocks")
+    if reuseSummaries:
+        runGoverned(
+            parallelWriteFunc, argsList, memEstimates, nCoresMax, memBudget=memBudget
+        )
+    else:
+        nReturns = runGoverned(
+            processBlock, argsList, memEstimates, nCoresMax, memBudget=memBudget
+        )
+        print("\t" + str(sum(nReturns)) + " returns summarized")
+
+    # -------------------------------------------------------------------------
+    # Merge Layers
+    # -------------------------------------------------------------------------
+    print("\tMerging layers")
+    for cellSize in cellSizes:
+        layerDir = "CellMetrics_" + formatIdentifier(cellSize)
+        dirMerged = os.path.join(dirFusionProducts, layerDir)
+        if not os.path.exists(dirMerged):
+            os.makedirs(dirMerged)
+        layers = set()
+        for blockName in os.listdir(dirFusionProductsBlocks):
+            dirLayers = os.path.join(dirFusionProductsBlocks, blockName, layerDir)
+            if os.path.isdir(dirLayers):
+                layers.update(f for f in os.listdir(dirLayers) if f.endswith(".asc"))
+        for layer in sorted(layers):
+            mergeBlockLayer(
+                layer,
+                layerDir,
+                dirFusionProductsBlocks,
+                dirFusionProducts,
+                dirFUSION,
+                getPRPProjection(prp),
+            )
+
+    stop = time.time()
+    print(str((stop - start) / 60) + "  minutes")
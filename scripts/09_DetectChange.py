@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Name:    09_DetectChange.py
+Purpose: Creates canopy, terrain, and metric change layers between two
+         acquisitions of the same area
+Author:  PA Fekety, Colorado State University, patrick.fekety@colostate.edu
+Date:    2021.04.27
+
+"""
+
+"""
+Notes:
+  Run this after 03_CreateGriddedMetrics.py has published both projects. The
+    CHM and metrics are read from dirFinalProducts; the ground models are read
+    from Products\BareGround_1METERS of each project in dirBase.
+  Change is later minus earlier, on a common EPSG:5070 grid covering the
+    overlap of the projects. For each layer, <layer>_change.tif and (if
+    breaks are given) <layer>_changeClass.tif are written to
+    dirChange\<earlier>_<later>, with ChangeSummary.csv.
+  Change classes are numbered from 1 (largest loss) by the breaks; e.g.,
+    [-5, -2, 2, 5] gives 1 (< -5), 2 (-5 to -2), 3 (no change), 4 (2 to 5),
+    and 5 (> 5). 0 is NoData.
+  Memory use is about nCoresMax * blockSize^2 * 40 bytes, whatever the size
+    of the projects.
+"""
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Import packages
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+import os
+import time
+from changeDetection import (
+    describeSources,
+    detectChange,
+    changeStatistics,
+    writeChangeSummary,
+)
+from productCatalog import productGroups
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Assign Variables
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+start = time.time()
+
+# Earlier and later projects
+projectEarlier = "CO_LarimerCo_GlenHaven_2013"
+projectLater = "CO_LovelandW_2016"
+print(projectEarlier + " to " + projectLater)
+
+# main output directory of 01_PrepareDataForFusion.py
+dirBase = r"D:\LidarProcessing"
+
+# directory where the final products were saved by 03_CreateGriddedMetrics.py
+dirFinalProducts = r"G:\FusionRuns"
+
+# directory of the change layers
+dirChange = r"G:\FusionChange"
+
+# Change classes of the CHM and ground (m); None skips the classes
+chmBreaks = [-5, -2, 2, 5]
+dtmBreaks = [-1, -0.25, 0.25, 1]
+
+# Cell size of the CHM and ground change; None uses the cell size of the data
+chmCellSize = None
+dtmCellSize = None
+
+# Metrics to compare and their change classes (None skips the classes)
+metricBreaks = {
+    "elev_P95_2plus_30METERS": [-5, -2, 2, 5],
+    "percentage_first_returns_above_2_30METERS": [-30, -10, 10, 30],
+}
+
+# Maximum number of processing cores
+nCoresMax = 26
+
+# Cells per side of the windows compared at once
+blockSize = 2048
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Define Functions
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+def chmFiles(project):
+    dirCHM = os.path.join(dirFinalProducts, project, "FusionOutputs", "CHM")
+    return [
+        os.path.join(dirCHM, f)
+        for f in sorted(os.listdir(dirCHM))
+        if f.lower().endswith((".asc", ".tif", ".img"))
+    ]
+
+
+def groundFiles(project):
+    # FUSION writes the same ground as .dtm and .asc; use one of them
+    dirGround = os.path.join(dirBase, project, "Products", "BareGround_1METERS")
+    fpDtms = [os.path.join(dirGround, f) for f in sorted(os.listdir(dirGround))]
+    if any(fp.lower().endswith(".dtm") for fp in fpDtms):
+        return [fp for fp in fpDtms if fp.lower().endswith(".dtm")]
+    return [fp for fp in fpDtms if fp.lower().endswith(".asc")]
+
+
+def metricFiles(project, metric):
+    dirOutputs = os.path.join(dirFinalProducts, project, "FusionOutputs")
+    for group in productGroups:
+        for ext in (".asc", ".tif", ".img"):
+            fpMetric = os.path.join(dirOutputs, group, metric + ext)
+            if os.path.exists(fpMetric):
+                return [fpMetric]
+    return []
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Detect Change
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+    dirOut = os.path.join(dirChange, projectEarlier + "_" + projectLater)
+    if not os.path.exists(dirOut):
+        os.makedirs(dirOut)
+
+    # layer name, files of each project, breaks, cell size
+    layers = [
+        ("CHM", chmFiles(projectEarlier), chmFiles(projectLater), chmBreaks, chmCellSize),
+        (
+            "DTM",
+            groundFiles(projectEarlier),
+            groundFiles(projectLater),
+            dtmBreaks,
+            dtmCellSize,
+        ),
+    ]
+    for metric, breaks in metricBreaks.items():
+        layers.append(
+            (
+                metric,
+                metricFiles(projectEarlier, metric),
+                metricFiles(projectLater, metric),
+                breaks,
+                None,
+            )
+        )
+
+    rows = []
+    for layer, fpEarlier, fpLater, breaks, cellSize in layers:
+        print("\t" + layer)
+        if len(fpEarlier) == 0 or len(fpLater) == 0:
+            print("\t\tnot in both projects")
+            continue
+        fpClasses = None
+        if breaks is not None:
+            fpClasses = os.path.join(dirOut, layer + "_changeClass.tif")
+        summary = detectChange(
+            describeSources(fpEarlier, nCores=nCoresMax),
+            describeSources(fpLater, nCores=nCoresMax),
+            fpChange=os.path.join(dirOut, layer + "_change.tif"),
+            fpClasses=fpClasses,
+            breaks=breaks,
+            cellSize=cellSize,
+            nCores=nCoresMax,
+            blockSize=blockSize,
+        )
+        if summary is None:
+            print("\t\tthe projects do not overlap")
+            continue
+        row = {"layer": layer, "earlier": projectEarlier, "later": projectLater}
+        row.update(changeStatistics(summary))
+        rows.append(row)
+
+    writeChangeSummary(rows, os.path.join(dirOut, "ChangeSummary.csv"))
+
+    stop = time.time()
+    print(str((stop - start) / 60) + "  minutes")
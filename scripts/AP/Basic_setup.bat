@@ -31,6 +31,11 @@ SET DOTOPO=TRUE
 
 SET DOFIRSTSTRATA=TRUE
 
+REM PYTHON and TILECONCURRENCY are used by tile_concurrent.bat. TILECONCURRENCY is the number of FUSION commands run at
+REM the same time within a tile. Each block runs its own tiles, so a computer runs up to (blocks x TILECONCURRENCY) commands.
+SET PYTHON=python
+SET TILECONCURRENCY=2
+
 REM flag to control conversion of all outputs to IMAGINE format. the default format is ASCII raster. IMAGINE format is much more compact
 REM and the files contain embedded projection information. projection info for ASCII raster files is help in a separate .PRJ file.
 REM PAF 201.01.12
@@ -243,6 +248,19 @@ IF /I [%UNITS%]==[feet] (
 	SET CANOPYSTATSCELLMULTIPLIER=30
 )
 
+REM Preview runs (previewMode in 01_PrepareDataForFusion.py) have an area name ending in _PREVIEW. They use thinned points,
+REM so the basic cell size is 3 times larger. 02_CreateAPSettingsPRP.R and 03_CreateGriddedMetrics.py use the same cell size.
+IF /I "%AREA:~-8%"=="_PREVIEW" (
+	IF /I [%UNITS%]==[feet] (
+		SET CELLSIZE=295.272
+		SET TOPOCELLSIZE=295.272
+	) ELSE (
+		SET CELLSIZE=90
+		SET TOPOCELLSIZE=90
+	)
+	SET CANOPYSTATSCELLMULTIPLIER=90
+)
+
 REM ###########################################################
 REM           Labels for output folders and files
 REM ###########################################################
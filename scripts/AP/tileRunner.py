@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+"""
+Name:    tileRunner.py
+Purpose: Runs the FUSION commands of tile.bat, running independent steps at
+         the same time
+Author:  PA Fekety, Colorado State University, patrick.fekety@colostate.edu
+Date:    2021.04.06
+
+"""
+
+"""
+Notes:
+  Called by tile_concurrent.bat with the same parameters AreaProcessor passes
+    to tile.bat. The settings come from the environment variables set in
+    Basic_setup.bat (DOGROUND, CLASSOPTION, DTMSPEC, ...).
+  tile.bat runs every command one after another. Here the commands are steps
+    of a dependency graph:
+      ground -> CanopyModel (not smoothed) -> clipdtm CSM
+             -> CanopyModel (smoothed) -> gridsurfacestats -> 5 x clipdtm
+                                       -> clipdtm CSM
+             -> gridmetrics (all returns)
+             -> gridmetrics (first returns)
+    A step starts when the steps it depends on have finished. At most
+    TILECONCURRENCY steps run at once in a tile. AreaProcessor runs one tile
+    per block at a time, so a computer runs up to (blocks x TILECONCURRENCY)
+    FUSION commands.
+  The canopy surfaces are written with a _BUFFERED suffix and clipped to the
+    final name, instead of being renamed to CSM_temp.dtm.
+  If a step fails, the steps that depend on it are skipped. The exit code,
+    time, and end of stderr of each step are appended to
+    PRODUCTHOME\Logs\TileSteps.csv.
+  --exe-dir runs the FUSION programs found in that folder instead of the ones
+    on the PATH, e.g. stub programs when testing without FUSION.
+"""
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Import packages
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+import os
+import sys
+import csv
+import time
+import shutil
+import asyncio
+import argparse
+import subprocess
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Steps
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+def envFlag(env, name):
+    # Basic_setup.bat flags are TRUE/FALSE in any case
+    return env.get(name, "").strip().upper() == "TRUE"
+
+
+def buildTileSteps(tile, extent, bufferedExtent, fileList, buffer, env):
+    # The steps of tile.bat as a dependency graph
+    # tile (str) - name of the buffered tile (e.g., TILE_C00001_R00002_S00001)
+    # extent, bufferedExtent (list) - minX, minY, maxX, maxY as strings
+    # fileList (str) - text file listing the lidar files of the tile
+    # buffer (str) - buffer width
+    # env (dict) - variables set by Basic_setup.bat
+    # returns a list of steps; each step is a dictionary with a name, the
+    #   names of the steps it runs after, and a command or files to delete
+    steps = []
+    productHome = env["PRODUCTHOME"]
+    coordInfo = env["COORDINFO"].split()
+    bufferedGridXY = ",".join(bufferedExtent)
+    outlier = "/outlier:" + env["OUTLIER"]
+    classOption = env.get("CLASSOPTION", "")
+    classOptions = [classOption] if classOption != "" else []
+    dtmSpec = env["DTMSPEC"]
+
+    # Ground
+    groundSteps = []
+    if envFlag(env, "DOGROUND"):
+        dirGround = os.path.join(productHome, "BareGround_" + env["GROUNDFILEIDENTIFIER"])
+        fpGroundPoints = os.path.join(dirGround, tile + "_BE_pts.las")
+        fpGroundBuffered = os.path.join(
+            dirGround, tile + "_BE_" + env["GROUNDFILEIDENTIFIER"] + "_BUFFERED.dtm"
+        )
+        fpGroundTrimmed = os.path.join(
+            dirGround, tile + "_BE_" + env["GROUNDFILEIDENTIFIER"] + "_TRIMMED.dtm"
+        )
+        if envFlag(env, "FILTERPOINTS"):
+            steps.append(
+                {
+                    "name": "GroundFilter",
+                    "after": [],
+                    "command": ["GroundFilter"]
+                    + classOptions
+                    + [
+                        "/extent:" + bufferedGridXY,
+                        fpGroundPoints,
+                        env["FILTERCELLSIZE"],
+                        fileList,
+                    ],
+                }
+            )
+            surfaceInput = ["GroundFilter"], [fpGroundPoints], []
+        else:
+            surfaceInput = [], [fileList], ["/class:2"]
+        steps.append(
+            {
+                "name": "GridSurfaceCreate",
+                "after": surfaceInput[0],
+                "command": ["GridSurfaceCreate"]
+                + surfaceInput[2]
+                + ["/gridxy:" + bufferedGridXY, fpGroundBuffered, env["GROUNDCELLSIZE"]]
+                + coordInfo
+                + surfaceInput[1],
+            }
+        )
+        steps.append(
+            {
+                "name": "ClipDtm ground",
+                "after": ["GridSurfaceCreate"],
+                "command": ["ClipDtm", fpGroundBuffered, fpGroundTrimmed] + extent,
+            }
+        )
+        groundSteps = ["GridSurfaceCreate"]
+
+    # Canopy surfaces and GridSurfaceStats
+    if envFlag(env, "DOCANOPY"):
+        cmOptions = ["/gridxy:" + bufferedGridXY, "/ground:" + dtmSpec, outlier] + classOptions
+        dirCanopy = os.path.join(productHome, "CanopyHeight_" + env["CANOPYFILEIDENTIFIER"])
+        dirTileMetrics = os.path.join(productHome, "TileMetrics_" + env["FILEIDENTIFIER"])
+        statsBase = os.path.join(dirTileMetrics, tile + "_" + env["CANOPYSTATSFILEIDENTIFIER"])
+        for surface, smooth in (("not_smoothed", []), ("3x_smoothed", ["/smooth:3"])):
+            fpFinal = os.path.join(
+                dirCanopy,
+                tile + "_filled_" + surface + "_" + env["CANOPYFILEIDENTIFIER"] + ".dtm",
+            )
+            fpBuffered = fpFinal[:-4] + "_BUFFERED.dtm"
+            steps.append(
+                {
+                    "name": "CanopyModel " + surface,
+                    "after": groundSteps,
+                    "command": ["CanopyModel"]
+                    + smooth
+                    + cmOptions
+                    + [fpBuffered, env["CANOPYCELLSIZE"]]
+                    + coordInfo
+                    + [fileList],
+                }
+            )
+            # clip canopy surface models back to the tile to remove problems
+            # around the edges related to smoothing
+            steps.append(
+                {
+                    "name": "clipdtm " + surface,
+                    "after": ["CanopyModel " + surface],
+                    "command": ["clipdtm", fpBuffered, fpFinal] + extent,
+                }
+            )
+            deleteAfter = ["clipdtm " + surface]
+            if surface == "3x_smoothed":
+                steps.append(
+                    {
+                        "name": "gridsurfacestats",
+                        "after": ["CanopyModel " + surface],
+                        "command": [
+                            "gridsurfacestats",
+                            "/halfcell",
+                            fpBuffered,
+                            statsBase,
+                            env["CANOPYSTATSCELLMULTIPLIER"],
+                        ],
+                    }
+                )
+                deleteAfter.append("gridsurfacestats")
+            steps.append(
+                {
+                    "name": "delete " + surface,
+                    "after": deleteAfter,
+                    "delete": [fpBuffered],
+                }
+            )
+
+        # clip the grid surface stats to the unbuffered tile extent
+        statsClips = [
+            ("surface_area_ratio", "rumple"),
+            ("surface_volume_ratio", "FPV"),
+            ("stddev_height", "sd_height"),
+            ("mean_height", "average_height"),
+            ("max_height", "maximum_height"),
+        ]
+        for statName, clipName in statsClips:
+            steps.append(
+                {
+                    "name": "clipdtm " + clipName,
+                    "after": ["gridsurfacestats"],
+                    "command": [
+                        "clipdtm",
+                        statsBase + "_" + statName + ".dtm",
+                        os.path.join(
+                            dirTileMetrics,
+                            tile + "_" + clipName + "_" + env["CANOPYSTATSFILEIDENTIFIER"] + ".dtm",
+                        ),
+                    ]
+                    + extent,
+                }
+            )
+        # delete the grid surface stat outputs that have a buffer around them
+        steps.append(
+            {
+                "name": "delete stats",
+                "after": ["clipdtm " + clipName for _, clipName in statsClips],
+                "delete": [
+                    statsBase + "_" + statName + ".dtm"
+                    for statName in [s for s, _ in statsClips]
+                    + ["surface_volume", "potential_volume"]
+                ],
+            }
+        )
+
+    # GridMetrics
+    if envFlag(env, "DOMETRICS"):
+        fpMetrics = os.path.join(
+            productHome, "TileMetrics_" + env["FILEIDENTIFIER"], tile + "_metrics.csv"
+        )
+        gmOptions = [
+            "/verbose",
+            "/minht:" + env["HTCUTOFF"],
+            "/buffer:" + buffer,
+            outlier,
+        ] + classOptions
+        gmOptions.append("/gridxy:" + ",".join(extent))
+        gmArgs = [dtmSpec, env["COVERCUTOFF"], env["CELLSIZE"], fpMetrics, fileList]
+
+        allOptions = list(gmOptions)
+        if envFlag(env, "OMITINTENSITY"):
+            allOptions.append("/nointensity")
+        if envFlag(env, "DOSTRATA"):
+            allOptions.append("/strata:" + env["STRATAHEIGHTS"])
+        if envFlag(env, "DOTOPO"):
+            allOptions.append("/topo:" + env["TOPOCELLSIZE"] + "," + env["LATITUDE"])
+        steps.append(
+            {
+                "name": "gridmetrics all returns",
+                "after": groundSteps,
+                "command": ["gridmetrics"] + allOptions + gmArgs,
+            }
+        )
+
+        if envFlag(env, "DOFIRSTMETRICS"):
+            # intensity metrics for first returns...ignore strata, topo, omitintensity
+            firstOptions = ["/verbose", "/first"] + gmOptions[1:]
+            if envFlag(env, "DOFIRSTSTRATA"):
+                firstOptions.append("/strata:" + env["STRATAHEIGHTS"])
+            steps.append(
+                {
+                    "name": "gridmetrics first returns",
+                    "after": groundSteps,
+                    "command": ["gridmetrics"] + firstOptions + gmArgs,
+                }
+            )
+
+    return steps
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Run Steps
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+def resolveCommand(command, exeDir):
+    # Uses the program in exeDir when it exists there
+    if exeDir is None:
+        return command
+    program = shutil.which(command[0], path=exeDir)
+    if program is None:
+        return command
+    return [program] + command[1:]
+
+
+async def runStep(step, dependencies, semaphore, exeDir):
+    # Waits for the dependencies, then runs the step
+    # returns the record of the step
+    record = {
+        "step": step["name"],
+        "returncode": None,
+        "seconds": None,
+        "stderr": "",
+        "command": " ".join(step.get("command", ["delete"] + step.get("delete", []))),
+    }
+    results = await asyncio.gather(*dependencies)
+    failed = [r["step"] for r in results if r["returncode"] != 0]
+    if len(failed) > 0:
+        record["stderr"] = "skipped; failed: " + ", ".join(failed)
+        return record
+
+    async with semaphore:
+        start = time.time()
+        if "command" in step:
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *resolveCommand(step["command"], exeDir),
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.PIPE
+                )
+                _, stderr = await process.communicate()
+                record["returncode"] = process.returncode
+                record["stderr"] = stderr.decode(errors="replace")[-2000:]
+            except OSError as e:
+                # the program does not exist
+                record["returncode"] = -1
+                record["stderr"] = str(e)
+        else:
+            # like DEL, missing files are not an error
+            record["returncode"] = 0
+            for fp in step["delete"]:
+                try:
+                    os.remove(fp)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    record["returncode"] = 1
+                    record["stderr"] = str(e)
+        record["seconds"] = round(time.time() - start, 2)
+    return record
+
+
+async def runSteps(steps, maxConcurrent, exeDir=None):
+    # Runs each step after the steps it depends on
+    # Steps must be listed after the steps they depend on
+    # maxConcurrent (int) - maximum number of steps running at once
+    # returns the records of the steps in the order of steps
+    semaphore = asyncio.Semaphore(maxConcurrent)
+    tasks = {}
+    for step in steps:
+        dependencies = [tasks[name] for name in step["after"]]
+        tasks[step["name"]] = asyncio.ensure_future(
+            runStep(step, dependencies, semaphore, exeDir)
+        )
+    return await asyncio.gather(*tasks.values())
+
+
+def runTile(steps, maxConcurrent, exeDir=None):
+    # Runs the steps of one tile in a new event loop
+    if sys.platform == "win32":
+        # subprocesses need the proactor event loop on Windows
+        loop = asyncio.ProactorEventLoop()
+    else:
+        loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(runSteps(steps, maxConcurrent, exeDir))
+    finally:
+        loop.close()
+
+
+def writeStepLog(records, tile, fpLog):
+    # Appends the records of a tile to a CSV file
+    fields = ["tile", "step", "returncode", "seconds", "stderr", "command"]
+    dirLog = os.path.dirname(fpLog)
+    if dirLog != "" and not os.path.exists(dirLog):
+        os.makedirs(dirLog)
+    newFile = not os.path.exists(fpLog)
+    with open(fpLog, "a", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        if newFile:
+            writer.writeheader()
+        for record in records:
+            row = dict(record)
+            row["tile"] = tile
+            writer.writerow(row)
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Command Line
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrent FUSION tile processing")
+    parser.add_argument("tile", help="name of the buffered tile")
+    parser.add_argument("extent", nargs=4, help="unbuffered minX minY maxX maxY")
+    parser.add_argument("bufferedExtent", nargs=4, help="buffered minX minY maxX maxY")
+    parser.add_argument("fileList", help="text file listing the lidar files")
+    parser.add_argument("buffer", help="buffer width")
+    parser.add_argument("tileWidth", nargs="?", help="not used")
+    parser.add_argument("tileHeight", nargs="?", help="not used")
+    parser.add_argument(
+        "--max-concurrent",
+        type=int,
+        default=int(os.environ.get("TILECONCURRENCY", "2")),
+        help="maximum number of steps running at once",
+    )
+    parser.add_argument("--exe-dir", default=None, help="folder of the FUSION programs")
+    parser.add_argument("--log", default=None, help="CSV file of the step records")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    steps = buildTileSteps(
+        args.tile, args.extent, args.bufferedExtent, args.fileList, args.buffer, env
+    )
+    records = runTile(steps, max(args.max_concurrent, 1), args.exe_dir)
+
+    fpLog = args.log
+    if fpLog is None:
+        fpLog = os.path.join(env["PRODUCTHOME"], "Logs", "TileSteps.csv")
+    writeStepLog(records, args.tile, fpLog)
+
+    failed = [r["step"] for r in records if r["returncode"] not in (0, None)]
+    skipped = [r["step"] for r in records if r["returncode"] is None]
+    if len(failed) > 0:
+        print(args.tile + " failed: " + ", ".join(failed))
+        print("\t" + str(len(skipped)) + " steps skipped")
+        sys.exit(1)
+    sys.exit(0)
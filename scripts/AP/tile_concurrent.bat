@@ -0,0 +1,17 @@
+REM Tile processing batch file for use with AreaProcessor
+REM Same as tile.bat, but the FUSION commands are run by tileRunner.py so that independent commands
+REM (e.g., the two CanopyModel runs and the two gridmetrics runs) run at the same time.
+REM Use it in place of tile.bat (TILEBATCH in 02_CreateAPSettingsPRP.R).
+
+REM Expected command line parameters are the same as tile.bat:
+REM    %1     Name of the buffered tile containing LIDAR data
+REM    %2-%5  Minimum X, minimum Y, maximum X, maximum Y for the unbuffered tile
+REM    %6-%9  Minimum X, minimum Y, maximum X, maximum Y for the buffered tile
+REM    %10    Name of the text file containing a list of all data files
+REM    %11    Buffer size
+REM    %12    Width of the unbuffered analysis tile
+REM    %13    Height of the unbuffered analysis tile
+
+REM PYTHON and TILECONCURRENCY are set in Basic_setup.bat. The options for the FUSION commands are read from the
+REM environment variables set in Basic_setup.bat. Each step is logged in %PRODUCTHOME%\Logs\TileSteps.csv
+%PYTHON% "%PROCESSINGHOME%\tileRunner.py" %* --max-concurrent %TILECONCURRENCY%
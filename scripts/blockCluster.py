@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+"""
+Name:    blockCluster.py
+Purpose: Runs FUSION processing blocks on several worker computers
+Author:  PA Fekety, Colorado State University, patrick.fekety@colostate.edu
+Date:    2021.03.16
+
+"""
+
+"""
+Notes:
+  A coordinator hands out jobs (one per processing block) to workers over a
+    TCP connection (multiprocessing.connection, so nothing extra to install).
+  Workers must be Windows computers with FUSION installed in the same folder
+    as the coordinator. The block batch files (and the lidar file lists they
+    use) contain the coordinator's absolute paths, so the workers must see
+    the project at the same paths (map the same drive letter, or use a UNC
+    path for dirBase). The path map (--map) only rewrites the command line
+    and working folder of a job, e.g. for a different drive letter of the
+    AP folder itself.
+  While a job runs, the worker sends a heartbeat and the coordinator answers
+    it. If a worker disconnects or misses heartbeats for leaseTimeout
+    seconds, its job is put back in the queue and given to another worker
+    (up to maxAttempts times).
+  A worker that gets no answer for leaseTimeout / 2 seconds kills its block
+    (the whole process tree) and exits. A requeued job waits leaseTimeout
+    seconds before it is handed out again, so the block of a lost worker is
+    stopped before another worker writes to the same block folder.
+  A job that finishes with a non-zero exit code is not retried; it is
+    reported in the results.
+  runLocalCluster() starts the workers as local processes so the whole thing
+    can be tested on one computer.
+
+  Start a worker on a Windows node with:
+    python blockCluster.py HOST PORT --authkey KEY
+"""
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Import packages
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+import os
+import re
+import sys
+import time
+import signal
+import socket
+import argparse
+import threading
+import subprocess
+import multiprocessing
+from collections import deque
+from multiprocessing.connection import Listener, Client
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Jobs
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+def createBlockJobs(blockScripts, commandTemplate="{script}", cwd=None):
+    # One job per processing block
+    # blockScripts (dict) - {blockName: batch file}; see findBlockScripts()
+    # commandTemplate (str) - command run by the worker; {script} is replaced
+    #   by the block batch file and {block} by the block name
+    jobs = []
+    for blockName in sorted(blockScripts, key=lambda b: int(b[5:])):
+        jobs.append(
+            {
+                "jobID": blockName,
+                "command": commandTemplate.format(
+                    script=blockScripts[blockName], block=blockName
+                ),
+                "cwd": cwd,
+            }
+        )
+    return jobs
+
+
+def mapPath(text, pathMap):
+    # Rewrites coordinator paths to worker paths
+    # pathMap (dict) - {coordinator prefix: worker prefix}
+    # Every path that starts with a prefix is rewritten. Windows prefixes are
+    # matched without case, and when a Windows prefix maps to a "/" prefix
+    # the rest of each path gets forward slashes.
+    if text is None:
+        return None
+    for prefixFrom, prefixTo in pathMap.items():
+        flags = re.IGNORECASE if "\\" in prefixFrom else 0
+        toSlashes = "\\" in prefixFrom and "/" in prefixTo
+
+        def replace(match):
+            rest = match.group(1)
+            if toSlashes:
+                rest = rest.replace("\\", "/")
+            return prefixTo + rest
+
+        # a path ends at a quote or white space
+        text = re.sub(re.escape(prefixFrom) + r'([^"\s]*)', replace, text, flags=flags)
+    return text
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Coordinator
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+class JobQueue:
+    # Jobs waiting, running, and finished; shared by the connection threads
+    def __init__(self, jobs, maxAttempts, requeueDelay=0):
+        self.lock = threading.Condition()
+        self.waiting = deque(jobs)
+        self.running = {}
+        self.attempts = {job["jobID"]: 0 for job in jobs}
+        # time a requeued job may be handed out again
+        self.notBefore = {}
+        self.results = {}
+        self.nJobs = len(jobs)
+        self.maxAttempts = maxAttempts
+        self.requeueDelay = requeueDelay
+
+    def nextJob(self):
+        # returns a job, "wait" if jobs are still running or fenced, or None
+        # when done
+        with self.lock:
+            now = time.time()
+            for job in self.waiting:
+                if self.notBefore.get(job["jobID"], 0) <= now:
+                    self.waiting.remove(job)
+                    self.attempts[job["jobID"]] += 1
+                    self.running[job["jobID"]] = job
+                    return job
+            if len(self.results) < self.nJobs:
+                return "wait"
+            return None
+
+    def finish(self, job, result):
+        with self.lock:
+            self.running.pop(job["jobID"], None)
+            result["attempts"] = self.attempts[job["jobID"]]
+            self.results[job["jobID"]] = result
+            self.lock.notify_all()
+
+    def requeue(self, job, workerName):
+        # the worker was lost; try the job again on another worker
+        with self.lock:
+            self.running.pop(job["jobID"], None)
+            if self.attempts[job["jobID"]] < self.maxAttempts:
+                print("\tWorker " + workerName + " lost; requeueing " + job["jobID"])
+                # the lost worker may still be running the block; it stops
+                # it within requeueDelay (see runJob())
+                self.notBefore[job["jobID"]] = time.time() + self.requeueDelay
+                self.waiting.appendleft(job)
+            else:
+                self.results[job["jobID"]] = {
+                    "jobID": job["jobID"],
+                    "worker": workerName,
+                    "returncode": None,
+                    "seconds": None,
+                    "stderr": "worker lost",
+                    "attempts": self.attempts[job["jobID"]],
+                }
+            self.lock.notify_all()
+
+    def done(self):
+        with self.lock:
+            return len(self.results) >= self.nJobs
+
+
+def serveWorker(conn, queue, leaseTimeout):
+    # Talks to one worker until it disconnects or there are no jobs left
+    job = None
+    workerName = "unknown"
+    try:
+        while True:
+            if not conn.poll(leaseTimeout):
+                raise TimeoutError("no heartbeat")
+            message = conn.recv()
+            if message[0] == "ready":
+                workerName = message[1]
+                job = queue.nextJob()
+                if job is None:
+                    conn.send(("stop",))
+                    return
+                if job == "wait":
+                    job = None
+                    conn.send(("wait", 2))
+                else:
+                    # the worker stops the job if heartbeats are not answered
+                    # within half the lease
+                    conn.send(("job", job, leaseTimeout / 2))
+            elif message[0] == "heartbeat":
+                conn.send(("ack",))
+            elif message[0] == "done":
+                result = message[1]
+                result["worker"] = workerName
+                queue.finish(job, result)
+                job = None
+    except (EOFError, OSError, TimeoutError):
+        if job is not None:
+            queue.requeue(job, workerName)
+    finally:
+        conn.close()
+
+
+def runCoordinator(jobs, listener, leaseTimeout=120, maxAttempts=3):
+    # Hands out jobs until every job has a result
+    # listener - multiprocessing.connection.Listener
+    # leaseTimeout (float) - seconds without a heartbeat before a worker is lost
+    # maxAttempts (int) - number of times a job is tried when workers are lost
+    # returns a list of results, one per job
+    queue = JobQueue(jobs, maxAttempts, requeueDelay=leaseTimeout)
+
+    def acceptWorkers():
+        while not queue.done():
+            try:
+                conn = listener.accept()
+            except OSError:
+                return
+            threading.Thread(
+                target=serveWorker, args=(conn, queue, leaseTimeout), daemon=True
+            ).start()
+
+    threading.Thread(target=acceptWorkers, daemon=True).start()
+    with queue.lock:
+        while len(queue.results) < queue.nJobs:
+            queue.lock.wait(5)
+    return [queue.results[job["jobID"]] for job in jobs]
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Worker
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+def killProcessTree(process):
+    # Stops a block and the FUSION programs it started
+    if sys.platform == "win32":
+        subprocess.run(
+            ["taskkill", "/F", "/T", "/PID", str(process.pid)],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+    else:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    process.wait()
+
+
+def runJob(job, conn, pathMap, heartbeat, fenceTimeout):
+    # Runs a job and sends a heartbeat while it runs
+    # fenceTimeout (float) - seconds without an answer from the coordinator
+    #   before the job is killed; the coordinator gives the job to another
+    #   worker after leaseTimeout, so this must be shorter than that
+    command = mapPath(job["command"], pathMap)
+    cwd = mapPath(job["cwd"], pathMap)
+    start = time.time()
+    if sys.platform == "win32":
+        process = subprocess.Popen(
+            command,
+            shell=True,
+            cwd=cwd,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+    else:
+        # a new session so the whole process group can be killed
+        process = subprocess.Popen(
+            command,
+            shell=True,
+            cwd=cwd,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            start_new_session=True,
+        )
+    # read stderr in a thread so a full pipe can not block the job
+    stderr = []
+    reader = threading.Thread(
+        target=lambda: stderr.append(process.stderr.read()), daemon=True
+    )
+    reader.start()
+    while process.poll() is None:
+        try:
+            process.wait(timeout=heartbeat)
+        except subprocess.TimeoutExpired:
+            try:
+                conn.send(("heartbeat", job["jobID"]))
+                answered = conn.poll(fenceTimeout)
+                if answered:
+                    conn.recv()
+            except (EOFError, OSError):
+                answered = False
+            if not answered:
+                # the coordinator has given up on this worker; stop the
+                # block before another worker starts it
+                killProcessTree(process)
+                raise ConnectionError("lost the coordinator; killed " + job["jobID"])
+    reader.join()
+    return {
+        "jobID": job["jobID"],
+        "returncode": process.returncode,
+        "seconds": round(time.time() - start, 1),
+        "stderr": b"".join(stderr).decode(errors="replace")[-2000:],
+    }
+
+
+def runWorker(address, authkey, pathMap=None, workerName=None, heartbeat=30):
+    # Asks the coordinator for jobs until it says stop
+    # address (tuple) - (host, port) of the coordinator
+    # authkey (bytes) - shared secret of the coordinator and workers
+    # pathMap (dict) - {coordinator prefix: worker prefix}
+    # heartbeat (float) - seconds between heartbeats; keep it well below half
+    #   of the coordinator leaseTimeout
+    if pathMap is None:
+        pathMap = {}
+    if workerName is None:
+        workerName = socket.gethostname() + ":" + str(os.getpid())
+    conn = Client(address, authkey=authkey)
+    try:
+        while True:
+            conn.send(("ready", workerName))
+            message = conn.recv()
+            if message[0] == "stop":
+                return
+            if message[0] == "wait":
+                time.sleep(message[1])
+                continue
+            conn.send(
+                ("done", runJob(message[1], conn, pathMap, heartbeat, message[2]))
+            )
+    except (EOFError, OSError):
+        # the coordinator went away
+        return
+    finally:
+        conn.close()
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Local Cluster
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+def runLocalCluster(jobs, nWorkers, leaseTimeout=120, maxAttempts=3, heartbeat=30):
+    # Runs the coordinator and nWorkers worker processes on this computer
+    authkey = os.urandom(16)
+    listener = Listener(("localhost", 0), authkey=authkey)
+    workers = [
+        multiprocessing.Process(
+            target=runWorker,
+            args=(listener.address, authkey),
+            kwargs={"workerName": "local" + str(i + 1), "heartbeat": heartbeat},
+        )
+        for i in range(nWorkers)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        results = runCoordinator(jobs, listener, leaseTimeout, maxAttempts)
+    finally:
+        listener.close()
+        for worker in workers:
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
+    return results
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Worker Command Line
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="FUSION block worker")
+    parser.add_argument("host", help="coordinator host name")
+    parser.add_argument("port", type=int, help="coordinator port")
+    parser.add_argument("--authkey", required=True, help="shared secret")
+    parser.add_argument(
+        "--map",
+        action="append",
+        default=[],
+        help="path map, COORDINATOR_PREFIX=WORKER_PREFIX (repeatable)",
+    )
+    parser.add_argument("--heartbeat", type=float, default=30)
+    args = parser.parse_args()
+
+    pathMap = dict(m.split("=", 1) for m in args.map)
+    runWorker(
+        (args.host, args.port),
+        args.authkey.encode(),
+        pathMap=pathMap,
+        heartbeat=args.heartbeat,
+    )
+    sys.exit(0)
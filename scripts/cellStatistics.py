@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+"""
+Name:    cellStatistics.py
+Purpose: Height metrics at several cell sizes from one pass over the points
+Author:  PA Fekety, Colorado State University, patrick.fekety@colostate.edu
+Date:    2021.04.20
+
+"""
+
+"""
+Notes:
+  The points of a block are read once from the point cache (pointCache.py)
+    and summarized at the finest cell size. The summaries can be added
+    together, so a coarser cell is the sum of the fine cells inside it:
+      return counts (all and first returns)
+      count, sum, sum of squares, cubes, and 4th powers of heights above
+        HTCUTOFF
+      minimum and maximum height above HTCUTOFF
+      height histogram above HTCUTOFF (binWidth bins)
+      returns above COVERCUTOFF (all and first returns)
+      return counts in each stratum (STRATAHEIGHTS)
+  The summary of each block is saved (.npz), so more cell sizes can be made
+    later without reading the points again. A cell size can only be added if
+    it divides the snap size of the summary (the least common multiple
+    below); otherwise the points must be summarized again.
+  Every cell size must be a multiple of the finest cell size. The block grid
+    is snapped to the least common multiple of the cell sizes so every cell
+    size lines up with the others and across blocks. Cells on the edge of a
+    block are complete because the cache holds the buffered points, so the
+    coarsest cell size must be no larger than the cache buffer.
+  Percentiles come from the histogram (linear within a bin), so they are
+    within binWidth of the exact percentile. Standard deviation, skewness,
+    and kurtosis use the same (n - 1) form as FUSION.
+"""
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Import packages
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+import os
+import json
+import math
+import numpy as np
+import rasterio as rio
+from rasterio.transform import from_origin
+from pointCache import readTileCache
+from topoMetrics import formatIdentifier
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Assign Variables
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Percentiles written for each cell size
+percentiles = [1, 5, 10, 20, 25, 30, 40, 50, 60, 70, 75, 80, 90, 95, 99]
+
+nodata = -9999
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Grid
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+def cellFactors(cellSizes):
+    # Number of finest cells across each cell size
+    # returns (finest cell size, {cell size: factor}, least common factor)
+    fineCellSize = min(cellSizes)
+    factors = {}
+    for cellSize in cellSizes:
+        factor = int(round(cellSize / fineCellSize))
+        if abs(factor * fineCellSize - cellSize) > 1e-6:
+            raise ValueError(
+                str(cellSize) + " is not a multiple of " + str(fineCellSize)
+            )
+        factors[cellSize] = factor
+    lcm = 1
+    for factor in factors.values():
+        lcm = lcm * factor // math.gcd(lcm, factor)
+    return fineCellSize, factors, lcm
+
+
+def snapExtent(extent, snapSize):
+    # Extent grown to multiples of snapSize
+    return (
+        math.floor(extent[0] / snapSize + 1e-9) * snapSize,
+        math.floor(extent[1] / snapSize + 1e-9) * snapSize,
+        math.ceil(extent[2] / snapSize - 1e-9) * snapSize,
+        math.ceil(extent[3] / snapSize - 1e-9) * snapSize,
+    )
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Summaries
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+def summarizeTile(
+    dirTile,
+    extent,
+    cellSizes,
+    htCutoff=2,
+    coverCutoff=2,
+    strataHeights=(0.5, 1, 2, 4, 8, 16, 32, 48, 64),
+    binWidth=0.5,
+    maxHeight=150,
+):
+    # Summarizes the cached points of a block at the finest cell size
+    # dirTile (str) - point cache of the block
+    # extent (tuple) - unbuffered block extent (minX, minY, maxX, maxY)
+    # cellSizes (list) - cell sizes that will be made from the summary
+    # htCutoff, coverCutoff, strataHeights - same as HTCUTOFF, COVERCUTOFF,
+    #   and STRATAHEIGHTS in Basic_setup.bat
+    # binWidth (float) - width of the height histogram bins
+    # maxHeight (float) - top of the histogram (upper OUTLIER)
+    # returns a dictionary of summary arrays (rows, columns[, bins])
+    fineCellSize, factors, lcm = cellFactors(cellSizes)
+    gridExtent = snapExtent(extent, fineCellSize * lcm)
+    points, meta = readTileCache(
+        dirTile, ["x", "y", "height", "returnNumber"]
+    )
+    bufferedExtent = meta["bufferedExtent"]
+    if (
+        gridExtent[0] < bufferedExtent[0]
+        or gridExtent[1] < bufferedExtent[1]
+        or gridExtent[2] > bufferedExtent[2]
+        or gridExtent[3] > bufferedExtent[3]
+    ):
+        raise ValueError(
+            "The point cache of "
+            + meta["tileName"]
+            + " does not cover the grid; rebuild it with a buffer of at least "
+            + str(max(cellSizes))
+        )
+    nCols = int(round((gridExtent[2] - gridExtent[0]) / fineCellSize))
+    nRows = int(round((gridExtent[3] - gridExtent[1]) / fineCellSize))
+    nCells = nRows * nCols
+
+    x = np.asarray(points["x"])
+    y = np.asarray(points["y"])
+    col = np.floor((x - gridExtent[0]) / fineCellSize).astype(np.int64)
+    row = np.floor((gridExtent[3] - y) / fineCellSize).astype(np.int64)
+    inside = (col >= 0) & (col < nCols) & (row >= 0) & (row < nRows)
+    del x, y
+    cell = (row * nCols + col)[inside]
+    height = np.asarray(points["height"], dtype=np.float64)[inside]
+    first = np.asarray(points["returnNumber"])[inside] == 1
+    del col, row, inside
+
+    summary = {
+        "gridExtent": np.array(gridExtent),
+        "fineCellSize": np.array(fineCellSize),
+        "snapSize": np.array(fineCellSize * lcm),
+        "htCutoff": np.array(htCutoff),
+        "coverCutoff": np.array(coverCutoff),
+        "strataHeights": np.array(strataHeights, dtype=np.float64),
+        "binWidth": np.array(binWidth),
+    }
+
+    def cellCount(mask):
+        return np.bincount(cell[mask], minlength=nCells).reshape(nRows, nCols)
+
+    allMask = np.ones(len(cell), dtype=bool)
+    summary["allCount"] = cellCount(allMask)
+    summary["firstCount"] = cellCount(first)
+    summary["allAboveCover"] = cellCount(height > coverCutoff)
+    summary["firstAboveCover"] = cellCount(first & (height > coverCutoff))
+
+    # moments, min, and max of the heights above HTCUTOFF
+    above = height > htCutoff
+    cellAbove = cell[above]
+    heightAbove = height[above]
+    summary["count"] = cellCount(above)
+    for power in (1, 2, 3, 4):
+        summary["sum" + str(power)] = np.bincount(
+            cellAbove, weights=heightAbove ** power, minlength=nCells
+        ).reshape(nRows, nCols)
+    minimum = np.full(nCells, np.inf)
+    maximum = np.full(nCells, -np.inf)
+    if len(cellAbove) > 0:
+        order = np.argsort(cellAbove, kind="stable")
+        sortedCells = cellAbove[order]
+        sortedHeights = heightAbove[order]
+        starts = np.flatnonzero(np.r_[True, sortedCells[1:] != sortedCells[:-1]])
+        minimum[sortedCells[starts]] = np.minimum.reduceat(sortedHeights, starts)
+        maximum[sortedCells[starts]] = np.maximum.reduceat(sortedHeights, starts)
+        del order, sortedCells, sortedHeights
+    summary["min"] = minimum.reshape(nRows, nCols)
+    summary["max"] = maximum.reshape(nRows, nCols)
+
+    # height histogram above HTCUTOFF
+    nBins = int(math.ceil((maxHeight - htCutoff) / binWidth))
+    bins = np.clip(((heightAbove - htCutoff) / binWidth).astype(np.int64), 0, nBins - 1)
+    summary["histogram"] = (
+        np.bincount(cellAbove * nBins + bins, minlength=nCells * nBins)
+        .reshape(nRows, nCols, nBins)
+        .astype(np.uint32)
+    )
+    del cellAbove, heightAbove, bins
+
+    # return counts in each stratum; the first is below the first height and
+    # the last is above the last height
+    stratum = np.searchsorted(np.asarray(strataHeights), height, side="right")
+    nStrata = len(strataHeights) + 1
+    summary["strata"] = (
+        np.bincount(cell * nStrata + stratum, minlength=nCells * nStrata)
+        .reshape(nRows, nCols, nStrata)
+        .astype(np.uint32)
+    )
+    return summary
+
+
+def saveSummary(summary, fpSummary):
+    np.savez(fpSummary, **summary)
+
+
+def loadSummary(fpSummary):
+    with np.load(fpSummary) as f:
+        return {name: f[name] for name in f.files}
+
+
+def aggregateSummary(summary, factor):
+    # Summary at factor times the finest cell size
+    # Sums are added and min/max are reduced over factor x factor blocks
+    if factor == 1:
+        return summary
+    coarse = dict(summary)
+    for name, values in summary.items():
+        if values.ndim < 2:
+            continue
+        nRows = values.shape[0] // factor
+        nCols = values.shape[1] // factor
+        blocks = values.reshape((nRows, factor, nCols, factor) + values.shape[2:])
+        if name == "min":
+            coarse[name] = blocks.min(axis=(1, 3))
+        elif name == "max":
+            coarse[name] = blocks.max(axis=(1, 3))
+        else:
+            coarse[name] = blocks.sum(axis=(1, 3))
+    return coarse
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Metrics
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+def histogramPercentiles(histogram, count, minimum, maximum, htCutoff, binWidth):
+    # Percentiles of the heights from the histogram of each cell
+    # returns {percentile: grid}
+    cumulative = np.cumsum(histogram, axis=-1, dtype=np.int64)
+    values = {}
+    for p in percentiles:
+        target = p / 100 * count
+        # first bin where the cumulative count reaches the target
+        index = (cumulative < target[..., None]).sum(axis=-1)
+        index = np.minimum(index, histogram.shape[-1] - 1)
+        below = np.where(
+            index > 0,
+            np.take_along_axis(cumulative, np.maximum(index - 1, 0)[..., None], -1)[..., 0],
+            0,
+        )
+        inBin = np.take_along_axis(histogram, index[..., None], -1)[..., 0]
+        fraction = np.where(inBin > 0, (target - below) / np.maximum(inBin, 1), 0)
+        value = htCutoff + (index + fraction) * binWidth
+        values[p] = np.clip(value, minimum, maximum)
+    return values
+
+
+def deriveMetrics(summary):
+    # Metric grids of a summary
+    # returns {name: grid}; names follow FUSION (e.g., elev_P95_2plus)
+    n = summary["count"].astype(np.float64)
+    valid = n > 0
+    htCutoff = float(summary["htCutoff"])
+    coverCutoff = float(summary["coverCutoff"])
+    htId = formatIdentifier(htCutoff, "") + "plus"
+    coverId = formatIdentifier(coverCutoff, "")
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = summary["sum1"] / n
+        # central moments from the raw sums
+        m2 = summary["sum2"] - summary["sum1"] ** 2 / n
+        m3 = (
+            summary["sum3"]
+            - 3 * summary["sum1"] * summary["sum2"] / n
+            + 2 * summary["sum1"] ** 3 / n ** 2
+        )
+        m4 = (
+            summary["sum4"]
+            - 4 * summary["sum1"] * summary["sum3"] / n
+            + 6 * summary["sum1"] ** 2 * summary["sum2"] / n ** 2
+            - 3 * summary["sum1"] ** 4 / n ** 3
+        )
+        variance = np.maximum(m2, 0) / (n - 1)
+        stddev = np.sqrt(variance)
+        skewness = np.where(stddev > 0, m3 / ((n - 1) * stddev ** 3), 0)
+        kurtosis = np.where(stddev > 0, m4 / ((n - 1) * stddev ** 4), 0)
+        stddev = np.where(n > 1, stddev, 0)
+        skewness = np.where(n > 1, skewness, 0)
+        kurtosis = np.where(n > 1, kurtosis, 0)
+
+        allCount = summary["allCount"].astype(np.float64)
+        firstCount = summary["firstCount"].astype(np.float64)
+        metrics = {
+            "elev_mean_" + htId: np.where(valid, mean, nodata),
+            "elev_stddev_" + htId: np.where(valid, stddev, nodata),
+            "elev_variance_" + htId: np.where(valid, np.where(n > 1, variance, 0), nodata),
+            "elev_skewness_" + htId: np.where(valid, skewness, nodata),
+            "elev_kurtosis_" + htId: np.where(valid, kurtosis, nodata),
+            "elev_min_" + htId: np.where(valid, summary["min"], nodata),
+            "elev_max_" + htId: np.where(valid, summary["max"], nodata),
+            "total_return_count_above_" + formatIdentifier(htCutoff, ""): n,
+            "total_all_returns": allCount,
+            "percentage_first_returns_above_" + coverId: np.where(
+                firstCount > 0, 100 * summary["firstAboveCover"] / firstCount, nodata
+            ),
+            "percentage_all_returns_above_" + coverId: np.where(
+                allCount > 0, 100 * summary["allAboveCover"] / allCount, nodata
+            ),
+        }
+
+    values = histogramPercentiles(
+        summary["histogram"],
+        summary["count"],
+        summary["min"],
+        summary["max"],
+        htCutoff,
+        float(summary["binWidth"]),
+    )
+    for p, grid in values.items():
+        metrics["elev_P" + str(p).zfill(2) + "_" + htId] = np.where(valid, grid, nodata)
+
+    # strata return counts and proportions
+    strataHeights = list(summary["strataHeights"])
+    bounds = [None] + strataHeights + [None]
+    for i in range(len(strataHeights) + 1):
+        if bounds[i] is None:
+            name = "strata_below_" + formatIdentifier(bounds[i + 1])
+        elif bounds[i + 1] is None:
+            name = "strata_above_" + formatIdentifier(bounds[i])
+        else:
+            name = (
+                "strata_"
+                + formatIdentifier(bounds[i])
+                + "_to_"
+                + formatIdentifier(bounds[i + 1])
+            )
+        counts = summary["strata"][..., i].astype(np.float64)
+        metrics[name + "_return_count"] = counts
+        with np.errstate(divide="ignore", invalid="ignore"):
+            metrics[name + "_return_proportion"] = np.where(
+                allCount > 0, counts / allCount, nodata
+            )
+    return metrics
+
+
+def writeCellMetrics(summary, cellSizes, dirBlock):
+    # Writes the metrics of a block summary at each cell size
+    # dirBlock (str) - output folder; a CellMetrics_<cell size> folder is made
+    #   for each cell size
+    fineCellSize, factors, lcm = cellFactors(cellSizes)
+    if abs(fineCellSize - float(summary["fineCellSize"])) > 1e-6:
+        raise ValueError("The summary was made with a different finest cell size")
+    # the grid of the summary is snapped to snapSize, so a cell size lines up
+    # with the grid (and across blocks) only if it divides snapSize
+    if "snapSize" not in summary:
+        raise ValueError(
+            "The summary does not record its snap size; summarize the points again"
+        )
+    snapSize = float(summary["snapSize"])
+    snapFactor = int(round(snapSize / fineCellSize))
+    misaligned = [
+        cellSize for cellSize, factor in sorted(factors.items()) if snapFactor % factor != 0
+    ]
+    if len(misaligned) > 0:
+        raise ValueError(
+            "Cell sizes "
+            + str(misaligned)
+            + " do not divide the snap size of the summary ("
+            + str(snapSize)
+            + "); summarize the points again"
+        )
+    gridExtent = summary["gridExtent"]
+    for cellSize, factor in sorted(factors.items()):
+        coarse = aggregateSummary(summary, factor)
+        metrics = deriveMetrics(coarse)
+        cellId = formatIdentifier(cellSize)
+        outDir = os.path.join(dirBlock, "CellMetrics_" + cellId)
+        if not os.path.exists(outDir):
+            os.makedirs(outDir)
+        nRows, nCols = coarse["count"].shape
+        kwds = {
+            "driver": "AAIGrid",
+            "width": nCols,
+            "height": nRows,
+            "count": 1,
+            "dtype": "float32",
+            "crs": "EPSG:5070",
+            "transform": from_origin(gridExtent[0], gridExtent[3], cellSize, cellSize),
+            "nodata": nodata,
+        }
+        for name, values in metrics.items():
+            fpOut = os.path.join(outDir, name + "_" + cellId + ".asc")
+            with rio.open(fpOut, "w", **kwds) as dst:
+                dst.write(values.astype(np.float32), 1)
+
+
+def processBlock(dirTile, extent, cellSizes, fpSummary, dirBlock, options):
+    # Summarizes a block, saves the summary, and writes its metrics
+    # options (dict) - keyword arguments of summarizeTile()
+    # returns the number of returns in the block
+    summary = summarizeTile(dirTile, extent, cellSizes, **options)
+    saveSummary(summary, fpSummary)
+    writeCellMetrics(summary, cellSizes, dirBlock)
+    return int(summary["allCount"].sum())
+
+
+def estimateSummaryMemory(dirTile, extent, cellSizes, binWidth=0.5, maxHeight=150):
+    # Estimated peak memory (bytes) of processBlock()
+    with open(os.path.join(dirTile, "tile.json")) as f:
+        nPoints = json.load(f)["nPoints"]
+    fineCellSize = min(cellSizes)
+    nCells = ((extent[2] - extent[0]) / fineCellSize + 1) * (
+        (extent[3] - extent[1]) / fineCellSize + 1
+    )
+    nBins = (maxHeight) / binWidth
+    # point columns and their cell indices; histogram as int64 and uint32
+    return int(nPoints * 60 + nCells * nBins * 12 + 300 * 1024 ** 2)
@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+"""
+Name:    changeDetection.py
+Purpose: Compares the grids of two acquisitions of the same area in windows
+Author:  PA Fekety, Colorado State University, patrick.fekety@colostate.edu
+Date:    2021.04.27
+
+"""
+
+"""
+Notes:
+  A layer of a project is a list of files (e.g., the CHM tiles, the ground
+    .dtm files, or one metric). The files are described once (extent, cell
+    size, NoData) and are only opened for the windows they intersect.
+  Both projects are resampled to a common EPSG:5070 grid covering the area
+    where they overlap. Grids with the same cell size as the common grid are
+    resampled bilinearly (no change when they are already aligned); finer
+    grids are averaged.
+  Change is later minus earlier. Change classes are numbered from 1 by the
+    breaks, e.g. breaks [-2, 2] gives 1 (loss of more than 2), 2 (no change),
+    and 3 (gain of more than 2). 0 is NoData.
+  Windows of blockSize cells are read and compared in parallel threads,
+    nCores at a time, and written by this process only, so neither grid is
+    ever held in memory. The summary statistics are added up window by window.
+"""
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Import packages
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+import csv
+import math
+import numpy as np
+import rasterio as rio
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from rasterio.warp import reproject
+from rasterio.windows import Window
+from joblib import Parallel, delayed
+from fusionDtm import readDtmHeader, readDtmWindow, dtmToFloat, dtmTransform
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Sources
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+def describeSource(fpRaster):
+    # Extent (cell edges), cell size, and NoData of a raster or .dtm file
+    if fpRaster.lower().endswith(".dtm"):
+        header = readDtmHeader(fpRaster)
+        spacing = header["columnSpacing"]
+        return {
+            "file": fpRaster,
+            "minX": header["originX"] - spacing / 2,
+            "minY": header["originY"] - spacing / 2,
+            "maxX": header["maxX"] + spacing / 2,
+            "maxY": header["maxY"] + spacing / 2,
+            "cellSize": spacing,
+            "nodata": None,
+        }
+    with rio.open(fpRaster) as src:
+        bounds = src.bounds
+        return {
+            "file": fpRaster,
+            "minX": bounds.left,
+            "minY": bounds.bottom,
+            "maxX": bounds.right,
+            "maxY": bounds.top,
+            "cellSize": src.res[0],
+            "nodata": src.nodata,
+        }
+
+
+def describeSources(fpRasters, nCores=8):
+    # Descriptions of the files of a layer; only the headers are read
+    if len(fpRasters) == 0:
+        raise ValueError("The layer has no files")
+    nCores = max(min(nCores, len(fpRasters)), 1)
+    return Parallel(n_jobs=nCores, prefer="threads")(
+        delayed(describeSource)(fp) for fp in fpRasters
+    )
+
+
+def sourcesExtent(sources):
+    return (
+        min(s["minX"] for s in sources),
+        min(s["minY"] for s in sources),
+        max(s["maxX"] for s in sources),
+        max(s["maxY"] for s in sources),
+    )
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Common Grid
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+def commonGrid(sourcesEarlier, sourcesLater, cellSize=None):
+    # Grid covering the overlap of two layers
+    # cellSize (float) - None uses the coarser cell size of the two layers
+    # returns (transform, width, height); width and height are 0 if the
+    #   layers do not overlap
+    if cellSize is None:
+        cellSize = max(s["cellSize"] for s in sourcesEarlier + sourcesLater)
+    extentEarlier = sourcesExtent(sourcesEarlier)
+    extentLater = sourcesExtent(sourcesLater)
+    # keep the earlier grid if it has the same cell size; otherwise snap to
+    # multiples of the cell size
+    if abs(sourcesEarlier[0]["cellSize"] - cellSize) < 1e-6:
+        offsetX = sourcesEarlier[0]["minX"] % cellSize
+        offsetY = sourcesEarlier[0]["maxY"] % cellSize
+    else:
+        offsetX = 0.0
+        offsetY = 0.0
+    minX = max(extentEarlier[0], extentLater[0])
+    minY = max(extentEarlier[1], extentLater[1])
+    maxX = min(extentEarlier[2], extentLater[2])
+    maxY = min(extentEarlier[3], extentLater[3])
+    minX = math.ceil((minX - offsetX) / cellSize - 1e-6) * cellSize + offsetX
+    maxY = math.floor((maxY - offsetY) / cellSize + 1e-6) * cellSize + offsetY
+    width = max(int(math.floor((maxX - minX) / cellSize + 1e-6)), 0)
+    height = max(int(math.floor((maxY - minY) / cellSize + 1e-6)), 0)
+    return from_origin(minX, maxY, cellSize, cellSize), width, height
+
+
+def readLayerWindow(sources, bounds, cellSize):
+    # Reads a window of a layer on the common grid
+    # bounds (tuple) - (minX, minY, maxX, maxY) on the common grid
+    # returns a float64 array with NaN where there is no data
+    width = int(round((bounds[2] - bounds[0]) / cellSize))
+    height = int(round((bounds[3] - bounds[1]) / cellSize))
+    transform = from_origin(bounds[0], bounds[3], cellSize, cellSize)
+    layer = np.full((height, width), np.nan, dtype=np.float64)
+    for source in sources:
+        if not (
+            source["minX"] < bounds[2]
+            and source["maxX"] > bounds[0]
+            and source["minY"] < bounds[3]
+            and source["maxY"] > bounds[1]
+        ):
+            continue
+        if source["cellSize"] < cellSize - 1e-6:
+            resampling = Resampling.average
+        else:
+            resampling = Resampling.bilinear
+        part = np.full((height, width), np.nan, dtype=np.float64)
+        if source["file"].lower().endswith(".dtm"):
+            # read the grid points of the window plus a margin for resampling
+            pad = max(source["cellSize"], cellSize)
+            grid, header = readDtmWindow(
+                source["file"],
+                (bounds[0] - pad, bounds[1] - pad, bounds[2] + pad, bounds[3] + pad),
+            )
+            if grid.size == 0:
+                continue
+            reproject(
+                source=dtmToFloat(grid),
+                destination=part,
+                src_transform=dtmTransform(header),
+                src_crs="EPSG:5070",
+                src_nodata=np.nan,
+                dst_transform=transform,
+                dst_crs="EPSG:5070",
+                dst_nodata=np.nan,
+                resampling=resampling,
+            )
+        else:
+            with rio.open(source["file"]) as src:
+                # .asc files without a .prj have no CRS; the products are EPSG:5070
+                crs = src.crs if src.crs is not None else "EPSG:5070"
+                reproject(
+                    source=rio.band(src, 1),
+                    destination=part,
+                    src_transform=src.transform,
+                    src_crs=crs,
+                    src_nodata=src.nodata,
+                    dst_transform=transform,
+                    dst_crs="EPSG:5070",
+                    dst_nodata=np.nan,
+                    resampling=resampling,
+                )
+        fill = np.isnan(layer) & ~np.isnan(part)
+        layer[fill] = part[fill]
+        if not np.isnan(layer).any():
+            break
+    return layer
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Change
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+def emptyChangeSummary(nClasses):
+    return {
+        "cells": 0,
+        "sumEarlier": 0.0,
+        "sumLater": 0.0,
+        "sum": 0.0,
+        "sumSq": 0.0,
+        "min": np.inf,
+        "max": -np.inf,
+        "classCells": np.zeros(nClasses + 1, dtype=np.int64),
+    }
+
+
+def mergeChangeSummaries(summaries, nClasses):
+    # Adds up window summaries
+    total = emptyChangeSummary(nClasses)
+    for summary in summaries:
+        for key in ("cells", "sumEarlier", "sumLater", "sum", "sumSq", "classCells"):
+            total[key] = total[key] + summary[key]
+        total["min"] = min(total["min"], summary["min"])
+        total["max"] = max(total["max"], summary["max"])
+    return total
+
+
+def compareWindow(sourcesEarlier, sourcesLater, bounds, cellSize, breaks=None):
+    # Change within one window
+    # breaks (list) - increasing change values between classes; None skips
+    #   the classes
+    # returns (change, classes, summary); change is NaN and classes are 0
+    #   where either layer has no data
+    earlier = readLayerWindow(sourcesEarlier, bounds, cellSize)
+    later = readLayerWindow(sourcesLater, bounds, cellSize)
+    change = later - earlier
+    valid = ~np.isnan(change)
+    nClasses = 0 if breaks is None else len(breaks) + 1
+    classes = np.zeros(change.shape, dtype=np.uint8)
+    if breaks is not None:
+        classes[valid] = np.digitize(change[valid], breaks) + 1
+
+    summary = emptyChangeSummary(nClasses)
+    values = change[valid]
+    if values.size > 0:
+        summary["cells"] = int(values.size)
+        summary["sumEarlier"] = float(earlier[valid].sum())
+        summary["sumLater"] = float(later[valid].sum())
+        summary["sum"] = float(values.sum())
+        summary["sumSq"] = float(np.square(values).sum())
+        summary["min"] = float(values.min())
+        summary["max"] = float(values.max())
+        summary["classCells"] = np.bincount(classes.ravel(), minlength=nClasses + 1)
+    return change, classes, summary
+
+
+def detectChange(
+    sourcesEarlier,
+    sourcesLater,
+    fpChange,
+    fpClasses=None,
+    breaks=None,
+    cellSize=None,
+    nCores=8,
+    blockSize=2048,
+    nodata=-9999,
+):
+    # Writes the change raster (and change classes) of one layer
+    # sourcesEarlier, sourcesLater (list) - output of describeSources()
+    # fpChange (str) - GeoTIFF of later minus earlier
+    # fpClasses (str) - GeoTIFF of the change classes; needs breaks
+    # returns the summary of the whole grid, or None if the layers do not overlap
+    transform, width, height = commonGrid(sourcesEarlier, sourcesLater, cellSize)
+    if width == 0 or height == 0:
+        return None
+    cellSize = transform.a
+    nClasses = 0 if breaks is None else len(breaks) + 1
+    profile = {
+        "driver": "GTiff",
+        "width": width,
+        "height": height,
+        "count": 1,
+        "dtype": "float32",
+        "crs": "EPSG:5070",
+        "transform": transform,
+        "nodata": nodata,
+        "tiled": True,
+        "blockxsize": 512,
+        "blockysize": 512,
+        "compress": "deflate",
+        "BIGTIFF": "IF_SAFER",
+    }
+    windows = [
+        Window(col, row, min(blockSize, width - col), min(blockSize, height - row))
+        for row in range(0, height, blockSize)
+        for col in range(0, width, blockSize)
+    ]
+
+    def windowBounds(window):
+        minX = transform.c + window.col_off * cellSize
+        maxY = transform.f - window.row_off * cellSize
+        return (minX, maxY - window.height * cellSize, minX + window.width * cellSize, maxY)
+
+    summaries = []
+    dstClasses = None
+    with rio.open(fpChange, "w", **profile) as dstChange:
+        if fpClasses is not None and breaks is not None:
+            profileClasses = dict(profile, dtype="uint8", nodata=0)
+            dstClasses = rio.open(fpClasses, "w", **profileClasses)
+        try:
+            for i in range(0, len(windows), nCores):
+                batch = windows[i : i + nCores]
+                parts = Parallel(n_jobs=len(batch), prefer="threads")(
+                    delayed(compareWindow)(
+                        sourcesEarlier, sourcesLater, windowBounds(window), cellSize, breaks
+                    )
+                    for window in batch
+                )
+                for window, (change, classes, summary) in zip(batch, parts):
+                    change[np.isnan(change)] = nodata
+                    dstChange.write(change.astype(np.float32), 1, window=window)
+                    if dstClasses is not None:
+                        dstClasses.write(classes, 1, window=window)
+                    summaries.append(summary)
+        finally:
+            if dstClasses is not None:
+                dstClasses.close()
+
+    total = mergeChangeSummaries(summaries, nClasses)
+    total["cellSize"] = cellSize
+    total["breaks"] = breaks
+    return total
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Summary
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+def changeStatistics(summary):
+    # Statistics of the change of one layer; areas are in hectares
+    n = summary["cells"]
+    cellArea = summary["cellSize"] ** 2 / 10000
+    stats = {
+        "cellSize": summary["cellSize"],
+        "cells": n,
+        "area_ha": n * cellArea,
+    }
+    if n > 0:
+        mean = summary["sum"] / n
+        stats["meanEarlier"] = summary["sumEarlier"] / n
+        stats["meanLater"] = summary["sumLater"] / n
+        stats["meanChange"] = mean
+        if n > 1:
+            variance = (summary["sumSq"] - n * mean ** 2) / (n - 1)
+            stats["sdChange"] = math.sqrt(max(variance, 0.0))
+        stats["minChange"] = summary["min"]
+        stats["maxChange"] = summary["max"]
+    if summary["breaks"] is not None:
+        for k in range(1, len(summary["breaks"]) + 2):
+            stats["class" + str(k) + "_ha"] = int(summary["classCells"][k]) * cellArea
+    return stats
+
+
+def writeChangeSummary(rows, fpCsv):
+    # Writes one row per layer; class columns are blank for layers without them
+    fields = []
+    for row in rows:
+        for field in row:
+            if field not in fields:
+                fields.append(field)
+    with open(fpCsv, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
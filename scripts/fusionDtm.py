@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+Name:    fusionDtm.py
+Purpose: Reads, clips, and writes FUSION .dtm surfaces without FUSION
+Author:  PA Fekety, Colorado State University, patrick.fekety@colostate.edu
+Date:    2021.03.23
+
+"""
+
+"""
+Notes:
+  FUSION .dtm files (PLANS DTM format) have a 200 byte header followed by
+    the elevations stored by column, west to east. Each column runs south to
+    north. The origin is the lower left grid point and values are grid
+    points, not cell corners. Voids are -1.
+  readDtm() returns a numpy memmap, so nothing is read until it is used.
+    The array is a north-up view (row 0 is the north edge) of the memmap,
+    not a copy.
+  describeDtms() replaces DTMDescribe.exe. It only reads the headers and runs
+    in parallel. It can be run from the command line the same way as
+    DTMDescribe.exe (02_CreateAPSettingsPRP.R does this when PYTHON is set):
+      python fusionDtm.py filelist.txt Summary.csv
+"""
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Import packages
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+import os
+import sys
+import csv
+import struct
+import numpy as np
+from rasterio.transform import from_origin
+from joblib import Parallel, delayed
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Header
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+headerSize = 200
+headerFormat = "<21s61sf7d2i7h"
+headerFields = [
+    "signature",
+    "name",
+    "version",
+    "originX",
+    "originY",
+    "minZ",
+    "maxZ",
+    "rotation",
+    "columnSpacing",
+    "pointSpacing",
+    "columns",
+    "points",
+    "xyUnits",
+    "zUnits",
+    "valueType",
+    "verticalDatum",
+    "horizontalDatum",
+    "coordinateSystem",
+    "coordinateZone",
+]
+
+# elevation value types: 0 short, 1 long, 2 float, 3 double
+valueTypes = {0: np.int16, 1: np.int32, 2: np.float32, 3: np.float64}
+
+# units codes used by FUSION
+unitNames = {0: "feet", 1: "meters", 2: "other"}
+
+voidValue = -1
+
+
+def readDtmHeader(fpDtm):
+    # Reads the header of a FUSION .dtm file
+    # returns a dictionary of the header values and the extent of the grid
+    with open(fpDtm, "rb") as f:
+        raw = f.read(headerSize)
+    if not raw.startswith(b"PLANS-PC BINARY .DTM"):
+        raise ValueError(fpDtm + " is not a FUSION .dtm file")
+    header = dict(zip(headerFields, struct.unpack_from(headerFormat, raw, 0)))
+    header["signature"] = header["signature"].split(b"\x00")[0].decode()
+    header["name"] = header["name"].split(b"\x00")[0].decode(errors="replace")
+    header["maxX"] = header["originX"] + (header["columns"] - 1) * header["columnSpacing"]
+    header["maxY"] = header["originY"] + (header["points"] - 1) * header["pointSpacing"]
+    return header
+
+
+def packDtmHeader(header):
+    # Header bytes for writeDtm()
+    values = []
+    for field in headerFields:
+        value = header[field]
+        if field in ("signature", "name"):
+            value = value.encode()
+        values.append(value)
+    raw = struct.pack(headerFormat, *values)
+    return raw + b"\x00" * (headerSize - len(raw))
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Grids
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+def readDtm(fpDtm, mode="r"):
+    # Maps a FUSION .dtm file into memory
+    # mode (str) - "r" read only; "r+" changes to the array are saved
+    # returns (array, header); array is north-up with shape (rows, columns)
+    header = readDtmHeader(fpDtm)
+    grid = np.memmap(
+        fpDtm,
+        dtype=np.dtype(valueTypes[header["valueType"]]).newbyteorder("<"),
+        mode=mode,
+        offset=headerSize,
+        shape=(header["columns"], header["points"]),
+    )
+    return grid.T[::-1], header
+
+
+def dtmWindow(header, bounds):
+    # Row and column slices of the north-up array that cover bounds
+    # bounds (tuple) - (minX, minY, maxX, maxY)
+    colStart = int(np.ceil((bounds[0] - header["originX"]) / header["columnSpacing"] - 1e-6))
+    colStop = int(np.floor((bounds[2] - header["originX"]) / header["columnSpacing"] + 1e-6)) + 1
+    pointStart = int(np.ceil((bounds[1] - header["originY"]) / header["pointSpacing"] - 1e-6))
+    pointStop = int(np.floor((bounds[3] - header["originY"]) / header["pointSpacing"] + 1e-6)) + 1
+    colStart = min(max(colStart, 0), header["columns"])
+    colStop = min(max(colStop, colStart), header["columns"])
+    pointStart = min(max(pointStart, 0), header["points"])
+    pointStop = min(max(pointStop, pointStart), header["points"])
+    # rows count down from the north edge
+    rows = slice(header["points"] - pointStop, header["points"] - pointStart)
+    return rows, slice(colStart, colStop), colStart, pointStart
+
+
+def readDtmWindow(fpDtm, bounds):
+    # Grid points of a .dtm file inside bounds
+    # returns (array, header of the window); the array is a view of the memmap
+    grid, header = readDtm(fpDtm)
+    rows, cols, colStart, pointStart = dtmWindow(header, bounds)
+    window = grid[rows, cols]
+    windowHeader = dict(header)
+    windowHeader["originX"] = header["originX"] + colStart * header["columnSpacing"]
+    windowHeader["originY"] = header["originY"] + pointStart * header["pointSpacing"]
+    windowHeader["columns"] = window.shape[1]
+    windowHeader["points"] = window.shape[0]
+    windowHeader["maxX"] = windowHeader["originX"] + (window.shape[1] - 1) * header["columnSpacing"]
+    windowHeader["maxY"] = windowHeader["originY"] + (window.shape[0] - 1) * header["pointSpacing"]
+    return window, windowHeader
+
+
+def writeDtm(fpDtm, grid, header):
+    # Writes a north-up array as a FUSION .dtm file
+    # header (dict) - needs originX, originY, columnSpacing, and pointSpacing;
+    #   other values default to meters, float, and the values of grid
+    grid = np.asarray(grid)
+    valueType = {np.dtype(v): k for k, v in valueTypes.items()}.get(grid.dtype, 2)
+    grid = grid.astype(valueTypes[valueType])
+    valid = grid[grid != voidValue]
+    out = {
+        "signature": "PLANS-PC BINARY .DTM",
+        "name": os.path.basename(fpDtm),
+        "version": 3.1,
+        "rotation": 0.0,
+        "xyUnits": 1,
+        "zUnits": 1,
+        "verticalDatum": 0,
+        "horizontalDatum": 0,
+        "coordinateSystem": 0,
+        "coordinateZone": 0,
+    }
+    for field in headerFields:
+        if field in header and field not in ("signature", "name"):
+            out[field] = header[field]
+    out["columns"] = grid.shape[1]
+    out["points"] = grid.shape[0]
+    out["valueType"] = valueType
+    out["minZ"] = float(valid.min()) if valid.size > 0 else 0.0
+    out["maxZ"] = float(valid.max()) if valid.size > 0 else 0.0
+    with open(fpDtm, "wb") as f:
+        f.write(packDtmHeader(out))
+        # back to columns running south to north
+        f.write(np.ascontiguousarray(grid[::-1].T).astype(grid.dtype.newbyteorder("<")).tobytes())
+
+
+def clipDtm(fpIn, fpOut, bounds):
+    # Same as FUSION ClipDtm
+    window, header = readDtmWindow(fpIn, bounds)
+    writeDtm(fpOut, window, header)
+
+
+def dtmToFloat(grid):
+    # Copy of a .dtm array as float64 with NaN for voids
+    grid = np.array(grid, dtype=np.float64)
+    grid[grid == voidValue] = np.nan
+    return grid
+
+
+def dtmTransform(header):
+    # rasterio/affine transform of a .dtm grid; cells are centered on the
+    # grid points
+    return from_origin(
+        header["originX"] - header["columnSpacing"] / 2,
+        header["maxY"] + header["pointSpacing"] / 2,
+        header["columnSpacing"],
+        header["pointSpacing"],
+    )
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# DTMDescribe
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+describeFields = [
+    "File name",
+    "Description",
+    "Origin X",
+    "Origin Y",
+    "Upper right X",
+    "Upper right Y",
+    "Columns",
+    "Rows",
+    "Column spacing",
+    "Row spacing",
+    "Min data value",
+    "Max data value",
+    "Horizontal units",
+    "Vertical units",
+    "Elevation type",
+]
+
+
+def describeDtm(fpDtm):
+    header = readDtmHeader(fpDtm)
+    return {
+        "File name": fpDtm,
+        "Description": header["name"],
+        "Origin X": header["originX"],
+        "Origin Y": header["originY"],
+        "Upper right X": header["maxX"],
+        "Upper right Y": header["maxY"],
+        "Columns": header["columns"],
+        "Rows": header["points"],
+        "Column spacing": header["columnSpacing"],
+        "Row spacing": header["pointSpacing"],
+        "Min data value": header["minZ"],
+        "Max data value": header["maxZ"],
+        "Horizontal units": unitNames.get(header["xyUnits"], "other"),
+        "Vertical units": unitNames.get(header["zUnits"], "other"),
+        "Elevation type": np.dtype(valueTypes[header["valueType"]]).name,
+    }
+
+
+def describeDtms(fpDtms, fpOut, nCores=8):
+    # Writes a CSV like DTMDescribe.exe for a list of .dtm files
+    nCores = max(min(nCores, len(fpDtms)), 1)
+    rows = Parallel(n_jobs=nCores, prefer="threads")(
+        delayed(describeDtm)(fpDtm) for fpDtm in fpDtms
+    )
+    with open(fpOut, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=describeFields)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+
+
+if __name__ == "__main__":
+    # python fusionDtm.py filelist.txt Summary.csv
+    with open(sys.argv[1]) as f:
+        fpDtms = [line.strip() for line in f if line.strip() != ""]
+    describeDtms(fpDtms, sys.argv[2], nCores=os.cpu_count())
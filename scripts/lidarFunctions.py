@@ -0,0 +1,579 @@
+# -*- coding: utf-8 -*-
+"""
+Name:    lidarFunctions.py
+Purpose: Functions shared by the lidar processing scripts
+Author:  PA Fekety, Colorado State University, patrick.fekety@colostate.edu
+Date:    2021.03.02
+
+"""
+
+"""
+Notes:
+  This file is imported by the numbered scripts in this directory. It is not
+    meant to be run on its own.
+
+  readLasHeader() is a Python version of publicHeaderDescription() in
+    02_CreateAPSettingsPRP.R
+
+  runGoverned() replaces calcNCores(). calcNCores() only compared nCoresMax
+    to the number of files; 26 PDAL jobs on dense tiles can use more RAM
+    than the computer has.
+"""
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Import packages
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+import os
+import re
+import csv
+import struct
+import shutil
+import subprocess
+import psutil
+import rasterio as rio
+import rasterio.windows
+import numpy as np
+from concurrent.futures import wait, FIRST_COMPLETED
+from joblib.externals.loky import get_reusable_executor
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# LAS Headers
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+def readLasHeader(fpLidar):
+    # Reads the public header block of a LAS or LAZ file
+    # The header of a LAZ file is not compressed, so no PDAL call is needed
+    # fpLidar (str) - file path to the lidar file
+    # returns a dictionary with the extent, point count, and record length
+    with open(fpLidar, "rb") as f:
+        header = f.read(375)
+    if header[0:4] != b"LASF":
+        raise ValueError(fpLidar + " is not a valid LAS file")
+
+    versionMinor = struct.unpack_from("<B", header, 25)[0]
+    pointFormat = struct.unpack_from("<B", header, 104)[0]
+    recordLength = struct.unpack_from("<H", header, 105)[0]
+    nPoints = struct.unpack_from("<I", header, 107)[0]
+    maxX, minX, maxY, minY, maxZ, minZ = struct.unpack_from("<6d", header, 179)
+
+    # LAS 1.4 moved the point count to a 64 bit field
+    if versionMinor >= 4 and nPoints == 0:
+        nPoints = struct.unpack_from("<Q", header, 247)[0]
+
+    return {
+        "fileName": os.path.basename(fpLidar),
+        "versionMinor": versionMinor,
+        # bits 6 and 7 flag LAZ compression
+        "pointFormat": pointFormat & 63,
+        "recordLength": recordLength,
+        "nPoints": nPoints,
+        "minX": minX,
+        "minY": minY,
+        "minZ": minZ,
+        "maxX": maxX,
+        "maxY": maxY,
+        "maxZ": maxZ,
+    }
+
+
+def listLidarFiles(dirLidar):
+    # Sorted list of the las/laz files in a directory
+    lidarFiles = [
+        f for f in os.listdir(dirLidar) if f.lower().endswith((".las", ".laz"))
+    ]
+    lidarFiles.sort()
+    return lidarFiles
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Preview
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+def selectPreviewFiles(dirLidar, lidarFiles, nGrid=4, filesPerCell=1):
+    # Spatially stratified sample of lidar files for a preview run
+    # The extent of all files is split into nGrid x nGrid cells. In each cell,
+    # the filesPerCell files whose centers are closest to the cell center are
+    # selected, so the sample covers the whole project.
+    # returns the sorted list of selected files
+    centers = {}
+    for lidarFile in lidarFiles:
+        if not lidarFile.lower().endswith((".las", ".laz")):
+            continue
+        header = readLasHeader(os.path.join(dirLidar, lidarFile))
+        centers[lidarFile] = (
+            (header["minX"] + header["maxX"]) / 2,
+            (header["minY"] + header["maxY"]) / 2,
+        )
+    minX = min(c[0] for c in centers.values())
+    maxX = max(c[0] for c in centers.values())
+    minY = min(c[1] for c in centers.values())
+    maxY = max(c[1] for c in centers.values())
+    cellWidth = max(maxX - minX, 1e-6) / nGrid
+    cellHeight = max(maxY - minY, 1e-6) / nGrid
+
+    cells = {}
+    for lidarFile, (x, y) in centers.items():
+        col = min(int((x - minX) / cellWidth), nGrid - 1)
+        row = min(int((y - minY) / cellHeight), nGrid - 1)
+        cells.setdefault((col, row), []).append(lidarFile)
+
+    selected = []
+    for (col, row), cellFiles in cells.items():
+        xMid = minX + (col + 0.5) * cellWidth
+        yMid = minY + (row + 0.5) * cellHeight
+        cellFiles.sort(
+            key=lambda f: (centers[f][0] - xMid) ** 2 + (centers[f][1] - yMid) ** 2
+        )
+        selected.extend(cellFiles[:filesPerCell])
+    selected.sort()
+    return selected
+
+
+def createThinningStage(thinning, step=10, voxelSize=1.0):
+    # PDAL stage that thins the points of a preview run
+    # thinning (str) - "decimation" keeps every step-th point; "voxel" keeps
+    #   the point closest to the center of each voxelSize voxel (units of the
+    #   SRS the points are in when the stage runs)
+    if thinning == "decimation":
+        return {"type": "filters.decimation", "step": step}
+    if thinning == "voxel":
+        return {"type": "filters.voxelcenternearestneighbor", "cell": voxelSize}
+    raise ValueError("thinning must be 'decimation' or 'voxel'")
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Resource Governor
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Memory used by a process before it reads any points (Python, PDAL, PROJ)
+taskMemoryOverhead = 300 * 1024 ** 2
+
+# PDAL holds points as doubles and reprojection adds working copies, so a
+# point in memory is larger than its LAS record
+pointMemoryMultiplier = 3
+
+
+def estimateReprojectMemory(fpLidar):
+    # Estimated peak memory (bytes) of reprojecting one lidar file with PDAL
+    # The whole file is read into memory, so memory scales with the points
+    # Files without a LAS header (.lax, .xml, ...) are still handed to PDAL,
+    # which logs the error, so they are estimated from their size
+    try:
+        header = readLasHeader(fpLidar)
+    except (ValueError, struct.error):
+        return int(os.path.getsize(fpLidar) * pointMemoryMultiplier + taskMemoryOverhead)
+    pointBytes = header["nPoints"] * header["recordLength"] * pointMemoryMultiplier
+    return int(pointBytes + taskMemoryOverhead)
+
+
+def estimateCatalogMemory(dirLidar):
+    # Estimated peak memory (bytes) of FUSION Catalog on a directory of lidar
+    # files. Catalog reads one file at a time, so the largest file matters.
+    largest = 0
+    for lidarFile in listLidarFiles(dirLidar):
+        header = readLasHeader(os.path.join(dirLidar, lidarFile))
+        largest = max(largest, header["nPoints"] * header["recordLength"])
+    return int(largest + taskMemoryOverhead)
+
+
+def runGoverned(func, argsList, memEstimates, nCoresMax, memBudget=None, memReserve=2):
+    # Runs func(*args) for each args in argsList in parallel processes
+    # A task is started only when a core is free, the projected memory of the
+    # running tasks plus the new task fits memBudget, and the new task fits in
+    # the RAM that is free right now. Parallelism drops while big tiles are
+    # running and rises again as they finish.
+    # func - function to run; it may be defined in the calling script
+    # argsList (list) - list of argument tuples
+    # memEstimates (list) - estimated peak memory (bytes) of each task
+    # nCoresMax (int) - maximum number of processing cores available
+    # memBudget (float) - GB all running tasks may use; None is 80% of free RAM
+    # memReserve (float) - GB of RAM left free for the operating system
+    # returns the results in the same order as argsList
+    if memBudget is None:
+        budget = psutil.virtual_memory().available * 0.8
+    else:
+        budget = memBudget * 1024 ** 3
+    reserve = memReserve * 1024 ** 3
+
+    nWorkers = max(min(nCoresMax, len(argsList)), 1)
+    executor = get_reusable_executor(max_workers=nWorkers)
+
+    # Start the largest tasks first so they do not end up running alone at
+    # the end of the run
+    pending = sorted(range(len(argsList)), key=lambda i: -memEstimates[i])
+    running = {}
+    results = [None] * len(argsList)
+    while len(pending) > 0 or len(running) > 0:
+        while len(pending) > 0 and len(running) < nWorkers:
+            i = pending[0]
+            projected = sum(memEstimates[j] for j in running.values())
+            available = psutil.virtual_memory().available - reserve
+            fits = (
+                projected + memEstimates[i] <= budget
+                and memEstimates[i] <= available
+            )
+            # A task that is too big for the budget still runs, but alone
+            if not fits and len(running) > 0:
+                break
+            running[executor.submit(func, *argsList[i])] = i
+            pending.pop(0)
+
+        # Check free RAM again every few seconds while tasks are waiting
+        done, _ = wait(list(running), timeout=5, return_when=FIRST_COMPLETED)
+        for future in done:
+            results[running.pop(future)] = future.result()
+    return results
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Tile Manifest
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# The manifest records the state of the LAZ5070 files when FUSION was run.
+# It is compared to the current files to find tiles that were redelivered.
+manifestFields = ["fileName", "fileSize", "modifiedTime", "minX", "minY", "maxX", "maxY"]
+
+
+def createTileManifest(dirLidar):
+    # Describes every lidar file in a directory
+    # dirLidar (str) - directory of the lidar files (e.g., LAZ5070)
+    manifest = {}
+    for lidarFile in listLidarFiles(dirLidar):
+        fpLidar = os.path.join(dirLidar, lidarFile)
+        header = readLasHeader(fpLidar)
+        fileStat = os.stat(fpLidar)
+        manifest[lidarFile] = {
+            "fileName": lidarFile,
+            "fileSize": fileStat.st_size,
+            "modifiedTime": round(fileStat.st_mtime, 3),
+            "minX": header["minX"],
+            "minY": header["minY"],
+            "maxX": header["maxX"],
+            "maxY": header["maxY"],
+        }
+    return manifest
+
+
+def writeTileManifest(manifest, fpManifest):
+    with open(fpManifest, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=manifestFields)
+        writer.writeheader()
+        for lidarFile in sorted(manifest):
+            writer.writerow(manifest[lidarFile])
+
+
+def readTileManifest(fpManifest):
+    manifest = {}
+    with open(fpManifest, newline="") as f:
+        for row in csv.DictReader(f):
+            manifest[row["fileName"]] = {
+                "fileName": row["fileName"],
+                "fileSize": int(row["fileSize"]),
+                "modifiedTime": float(row["modifiedTime"]),
+                "minX": float(row["minX"]),
+                "minY": float(row["minY"]),
+                "maxX": float(row["maxX"]),
+                "maxY": float(row["maxY"]),
+            }
+    return manifest
+
+
+def findChangedExtents(manifestOld, manifestNew):
+    # Compares two manifests
+    # Returns a dictionary of {fileName: [extents]} for added, changed, and
+    # removed files. Changed files contribute both the old and new extent
+    # because a redelivered tile may not cover the same area.
+    changed = {}
+    for lidarFile, new in manifestNew.items():
+        old = manifestOld.get(lidarFile)
+        extentNew = (new["minX"], new["minY"], new["maxX"], new["maxY"])
+        if old is None:
+            changed[lidarFile] = [extentNew]
+        elif (
+            old["fileSize"] != new["fileSize"]
+            or old["modifiedTime"] != new["modifiedTime"]
+        ):
+            extentOld = (old["minX"], old["minY"], old["maxX"], old["maxY"])
+            changed[lidarFile] = [extentOld, extentNew]
+    for lidarFile, old in manifestOld.items():
+        if lidarFile not in manifestNew:
+            changed[lidarFile] = [(old["minX"], old["minY"], old["maxX"], old["maxY"])]
+    return changed
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# PRP and AreaProcessor Scripts
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+def readPRP(fpPRP):
+    # Reads a FUSION AreaProcessor PRP file (see 02_CreateAPSettingsPRP.R)
+    # returns a dictionary of sections; each section is a dictionary of key:value
+    sections = {}
+    section = None
+    with open(fpPRP) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("[") and line.endswith("]"):
+                section = line[1:-1]
+                sections[section] = {}
+            elif "=" in line and section is not None:
+                key, value = line.split("=", 1)
+                sections[section][key] = value
+    return sections
+
+
+def getPRPBlocks(prp):
+    # Processing blocks written by writeSection10() in 02_CreateAPSettingsPRP.R
+    # Object_i=1,xMinBlock,yMinBlock,xMaxBlock,yMaxBlock,BLOCKID,BLOCKNAME
+    blocks = []
+    for key, value in prp["ProcessingBlocks"].items():
+        if not key.startswith("Object_"):
+            continue
+        values = value.split(",")
+        blocks.append(
+            {
+                "blockID": int(values[5]),
+                "blockName": values[6],
+                "minX": float(values[1]),
+                "minY": float(values[2]),
+                "maxX": float(values[3]),
+                "maxY": float(values[4]),
+            }
+        )
+    blocks.sort(key=lambda block: block["blockID"])
+    return blocks
+
+
+def getPRPProjection(prp):
+    # Projection file of the layers (BASEPRJ in Basic_setup.bat), written by
+    # writeSection5() in 02_CreateAPSettingsPRP.R as ProjectionDirName
+    # returns None if the PRP has no projection file
+    fpPrj = prp.get("Scripts", {}).get("ProjectionDirName", "")
+    if fpPrj == "":
+        return None
+    return fpPrj
+
+
+def extentsIntersect(a, b):
+    # a, b (tuple) - (minX, minY, maxX, maxY)
+    return a[0] < b[2] and a[2] > b[0] and a[1] < b[3] and a[3] > b[1]
+
+
+def bufferExtent(extent, buffer):
+    return (
+        extent[0] - buffer,
+        extent[1] - buffer,
+        extent[2] + buffer,
+        extent[3] + buffer,
+    )
+
+
+def findDirtyBlocks(blocks, changedExtents, buffer):
+    # Blocks whose area intersects a changed lidar file (plus the buffer)
+    # blocks (list) - output of getPRPBlocks()
+    # changedExtents (list) - extents of changed lidar files
+    # buffer (float) - BufferWidth from the PRP
+    dirtyBlocks = []
+    for block in blocks:
+        blockExtent = (block["minX"], block["minY"], block["maxX"], block["maxY"])
+        for extent in changedExtents:
+            if extentsIntersect(bufferExtent(extent, buffer), blockExtent):
+                dirtyBlocks.append(block)
+                break
+    return dirtyBlocks
+
+
+def findBlockScripts(dirFusionProcessingAP, primaryBatchFile="APFusion.bat"):
+    # AreaProcessor writes one batch file per processing block. Each of them
+    # sets BLOCKNAME before calling the setup batch file (see Basic_setup.bat).
+    # returns a dictionary of {blockName: batch file path}
+    blockScripts = {}
+    pattern = re.compile(r"SET\s+\"?BLOCKNAME=(BLOCK\d+)\b", re.IGNORECASE)
+    for batchFile in sorted(os.listdir(dirFusionProcessingAP)):
+        if not batchFile.lower().endswith(".bat"):
+            continue
+        if batchFile.lower() == primaryBatchFile.lower():
+            continue
+        with open(os.path.join(dirFusionProcessingAP, batchFile)) as f:
+            match = pattern.search(f.read())
+        if match:
+            blockScripts[match.group(1).upper()] = os.path.join(
+                dirFusionProcessingAP, batchFile
+            )
+    return blockScripts
+
+
+def filterBlockScript(fpBlockScript, fpOut, changedExtents, buffer):
+    # Writes a copy of a block batch file that only processes dirty tiles
+    # Lines that do not reference a tile (setup, posttile) are kept. Calls to
+    # postblock.bat are dropped; the caller merges the touched layers itself.
+    # Tile extents are taken from the calls to tile.bat, where parameters
+    # 2-9 are the unbuffered and buffered tile corners.
+    # returns the list of dirty tile names
+    patternTile = re.compile(r"\b(TILE_C\d+_R\d+(?:_S\d+)?)\b")
+    with open(fpBlockScript) as f:
+        lines = f.readlines()
+
+    tileNames = set()
+    tileExtents = {}
+    for line in lines:
+        for match in patternTile.finditer(line):
+            tileNames.add(match.group(1))
+            args = line[match.end() :].replace('"', " ").split()
+            try:
+                corners = [float(e) for e in args[0:8]]
+            except ValueError:
+                continue
+            if len(corners) == 8:
+                tileExtents[match.group(1)] = tuple(corners[4:8])
+
+    dirtyTiles = set()
+    for tileName in tileNames:
+        if tileName not in tileExtents:
+            # can not determine the extent; do not risk skipping the tile
+            dirtyTiles.add(tileName)
+            continue
+        for extent in changedExtents:
+            if extentsIntersect(bufferExtent(extent, buffer), tileExtents[tileName]):
+                dirtyTiles.add(tileName)
+                break
+
+    with open(fpOut, "w") as f:
+        for line in lines:
+            if "postblock" in line.lower():
+                continue
+            tiles = patternTile.findall(line)
+            if len(tiles) == 0 or any(t in dirtyTiles for t in tiles):
+                f.write(line)
+    return sorted(dirtyTiles)
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Grids
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+def cleanGrids(inFiles, outDir, fpElev, extents=None):
+    # Sets NoData cells to 0 where elevation has data
+    # inFiles (list) - file paths of the FUSION grids
+    # outDir (str) - directory of the cleaned grids
+    # fpElev (str) - file path of the elevation grid
+    # extents (list) - optional (minX, minY, maxX, maxY) windows. When given
+    #   and a cleaned grid already exists, only cells in these windows are
+    #   recomputed; everything else is kept from the existing cleaned grid.
+
+    # Read in Elevation Raster
+    with rio.open(fpElev) as src:
+        rasElev = src.read()
+        kwds = src.profile
+
+    for inFile in inFiles:
+        # Read in raster to be processed
+        with rio.open(inFile) as src:
+            rasMetric = src.read()
+        # name of the metric
+        metric = os.path.basename(inFile)
+
+        # Save
+        if not os.path.exists(outDir):
+            os.mkdir(outDir)
+        fpCleanMetric = os.path.join(outDir, metric)
+
+        rasCleanMetric = None
+        if extents is not None and os.path.exists(fpCleanMetric):
+            with rio.open(fpCleanMetric) as src:
+                rasCleanMetric = src.read()
+            if rasCleanMetric.shape != rasElev.shape:
+                # The grid changed size; clean the whole thing
+                rasCleanMetric = None
+
+        if rasCleanMetric is None:
+            check = np.logical_and(
+                rasMetric == -9999, rasElev != -9999
+            )  # Create check raster with True/False values
+            rasCleanMetric = np.where(check, 0, rasMetric)
+        else:
+            for extent in extents:
+                rows, cols = extentToSlices(extent, kwds["transform"], rasElev.shape)
+                check = np.logical_and(
+                    rasMetric[:, rows, cols] == -9999, rasElev[:, rows, cols] != -9999
+                )
+                rasCleanMetric[:, rows, cols] = np.where(
+                    check, 0, rasMetric[:, rows, cols]
+                )
+
+        with rio.open(fpCleanMetric, "w", **kwds) as dst:
+            dst.write(rasCleanMetric)
+
+
+def extentToSlices(extent, transform, shape):
+    # Row and column slices of a raster that cover an extent
+    # extent (tuple) - (minX, minY, maxX, maxY)
+    # shape (tuple) - (bands, rows, columns) of the raster
+    window = rio.windows.from_bounds(*extent, transform=transform)
+    window = window.round_offsets(op="floor").round_lengths(op="ceil")
+    rowStart = min(max(int(window.row_off), 0), shape[1])
+    rowStop = min(max(int(window.row_off + window.height), 0), shape[1])
+    colStart = min(max(int(window.col_off), 0), shape[2])
+    colStop = min(max(int(window.col_off + window.width), 0), shape[2])
+    return slice(rowStart, rowStop), slice(colStart, colStop)
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# FUSION
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+def mergeBlockLayer(
+    layer, layerDir, dirProductsBlocks, dirFinalProducts, dirFUSION, fpBasePrj=None
+):
+    # Merges one layer across all processing blocks, like mergelayer.bat
+    # layer (str) - file name of the layer (e.g., elev_P95_2plus_30METERS.asc)
+    # layerDir (str) - product folder (e.g., Metrics_30METERS)
+    # dirProductsBlocks (str) - Products_Blocks folder
+    # dirFinalProducts (str) - folder of the merged layer
+    # fpBasePrj (str) - projection file copied next to the merged layer
+    #   (BASEPRJ; see getPRPProjection()); None writes no .prj
+    # convert2img.bat is not run; Basic_setup.bat sets CONVERTTOIMG=FALSE
+    layerFiles = []
+    for blockName in sorted(os.listdir(dirProductsBlocks)):
+        fpLayer = os.path.join(dirProductsBlocks, blockName, layerDir, layer)
+        if os.path.exists(fpLayer):
+            layerFiles.append(fpLayer)
+    if len(layerFiles) == 0:
+        return
+
+    fpLayerFiles = os.path.join(dirProductsBlocks, "layerfiles_" + layer + ".txt")
+    with open(fpLayerFiles, "w") as f:
+        for fpLayer in layerFiles:
+            f.write(fpLayer)
+            f.write("\n")
+
+    if layer.lower().endswith(".dtm"):
+        exeMerge = os.path.join(dirFUSION, "MergeDTM.exe")
+    else:
+        exeMerge = os.path.join(dirFUSION, "MergeRaster.exe")
+    fpOut = os.path.join(dirFinalProducts, layerDir, layer)
+    cmdMerge = exeMerge + " /overlap:max " + '"' + fpOut + '" "' + fpLayerFiles + '"'
+    result = subprocess.run(cmdMerge, shell=True)
+    os.remove(fpLayerFiles)
+    if result.returncode != 0:
+        raise RuntimeError(
+            os.path.basename(exeMerge)
+            + " returned "
+            + str(result.returncode)
+            + " for "
+            + fpOut
+        )
+
+    # copy base projection info
+    if fpBasePrj is not None:
+        shutil.copyfile(fpBasePrj, os.path.splitext(fpOut)[0] + ".prj")
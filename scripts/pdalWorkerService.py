@@ -0,0 +1,508 @@
+# -*- coding: utf-8 -*-
+"""
+Name:    pdalWorkerService.py
+Purpose: Keeps a pool of PDAL workers running between projects and runs the
+         reprojection and QAQC jobs of 01_PrepareDataForFusion.py
+Author:  PA Fekety, Colorado State University, patrick.fekety@colostate.edu
+Date:    2021.05.04
+
+"""
+
+"""
+Notes:
+  Each run of 01_PrepareDataForFusion.py starts new workers that import pdal,
+    load the PROJ database and geoid grids for EPSG:5070+5703, and build the
+    pipelines again. The service starts its workers once; they stay loaded
+    until the service is stopped, so later files and projects skip that cost.
+  Start the service from this folder (the 01 scripts start it if it is not
+    running and leave it running):
+      python pdalWorkerService.py --workers 26 --mem-budget 100
+    Stop it with:
+      python pdalWorkerService.py --stop
+    FUSION Catalog is run from --catalog (default C:\Fusion\Catalog.exe); the
+    01 scripts start the service with the Catalog.exe in dirFUSION. A
+    running service keeps the Catalog.exe it was started with.
+  Jobs are sent over a local socket (multiprocessing.connection, localhost
+    only). Jobs are unpickled by the service, so only clients with the
+    authentication key are accepted. The service makes a new random key each
+    time it starts and saves it in ~\.cms2lidar\pdalWorkerService.key, which
+    only the user who started the service can read (the folder is in the
+    user's profile; on Linux the file is also chmod 600). Clients read the
+    key from that file, so run the 01 scripts as the same user.
+  A job is a dictionary with a "type" ("reproject" or "qaqc"), the
+    arguments of the job, and "memEstimate" (bytes). QAQC jobs only give the
+    folders and the Catalog switches (e.g., /density:400,4,16); other
+    switches are refused, and Catalog is run without a shell.
+  Like runGoverned(), a job starts when a worker is free and its memory
+    fits in the budget; a job too big for the budget runs alone.
+  If a worker dies (e.g., PDAL crashes), the jobs running at that time
+    return "worker failed: ..." as their error, their memory is released, and
+    new workers are started for the next jobs.
+  Each worker keeps the pipeline template of every source SRS it has seen
+    and runs one point through filters.reprojection when it starts, so PROJ
+    has loaded the grids before the first file.
+  Reprojection errors are appended to _Error.log in the output folder, the
+    same as parallelProjectFunc().
+"""
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Import packages
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+import os
+import re
+import sys
+import copy
+import json
+import time
+import argparse
+import threading
+import subprocess
+import multiprocessing
+from multiprocessing.connection import Listener, Client
+import psutil
+from joblib.externals.loky import get_reusable_executor
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Settings
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+serviceAddress = ("localhost", 6070)
+
+# authentication key of the running service
+fpServiceKey = os.path.join(
+    os.path.expanduser("~"), ".cms2lidar", "pdalWorkerService.key"
+)
+
+# FUSION Catalog used by the QAQC jobs; set with --catalog
+defaultCatalog = r"C:\Fusion\Catalog.exe"
+
+# Catalog switches a QAQC job may use, e.g. /rawcounts or /density:400,4,16
+catalogSwitch = re.compile(r"^/[A-Za-z]+(:[0-9.,]+)?$")
+
+# SRS of the projected lidar files
+outSRS = "EPSG:5070+5703"
+
+# A NAD83(2011) 3D point in Colorado; reprojecting it to outSRS loads the
+# PROJ database and the geoid grid
+warmSRS = "EPSG:6319"
+warmPoint = (-105.5, 39.0, 2500.0)
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Workers
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# pipeline templates of this worker, by source SRS and thinning stage
+pipelineTemplates = {}
+
+# FUSION Catalog of this worker; set by warmWorker()
+exeCatalog = defaultCatalog
+
+
+def warmWorker(fpCatalog=defaultCatalog):
+    # Pool initializer; imports pdal and loads PROJ once per worker
+    # fpCatalog (str) - FUSION Catalog.exe used by the QAQC jobs
+    global pdal, exeCatalog
+    import pdal
+
+    exeCatalog = fpCatalog
+
+    warmPipeline = [
+        {
+            "type": "readers.faux",
+            "mode": "constant",
+            "count": 1,
+            "bounds": "(["
+            + "],[".join(str(v) + "," + str(v) for v in warmPoint)
+            + "])",
+            "spatialreference": warmSRS,
+        },
+        {"type": "filters.reprojection", "in_srs": warmSRS, "out_srs": outSRS},
+    ]
+    try:
+        pdal.Pipeline(json.dumps(warmPipeline)).execute()
+    except Exception:
+        # older PDAL without readers.faux; the first file loads PROJ instead
+        pass
+
+
+def pipelineTemplate(srsIn, thinStage=None):
+    # Reprojection pipeline without file names; same stages as
+    # parallelProjectFunc() in 01_PrepareDataForFusion.py
+    # srsIn - EPSG code of the lidar files; None uses the SRS in the files
+    # thinStage (dict) - optional PDAL stage that thins the points (preview mode)
+    key = (str(srsIn), json.dumps(thinStage, sort_keys=True))
+    if key not in pipelineTemplates:
+        reader = {"type": "readers.las"}
+        reprojection = {"type": "filters.reprojection", "out_srs": outSRS}
+        if srsIn is not None:
+            # Explicitly define SRS
+            reader["spatialreference"] = "EPSG:" + str(srsIn)
+            reprojection["in_srs"] = "EPSG:" + str(srsIn)
+        template = [
+            reader,
+            reprojection,
+            {
+                "type": "writers.las",
+                "scale_x": "0.01",
+                "scale_y": "0.01",
+                "scale_z": "0.01",
+                "offset_x": "auto",
+                "offset_y": "auto",
+                "offset_z": "auto",
+                "compression": "laszip",
+            },
+        ]
+        # thin the points before they are reprojected
+        if thinStage is not None:
+            template.insert(1, thinStage)
+        pipelineTemplates[key] = template
+    return pipelineTemplates[key]
+
+
+def reprojectFile(fpLidar, dirLAZ5070, srsIn=None, thinStage=None):
+    # Projects a lidar file to EPSG:5070+5703 as LAZ
+    # returns the error message, or None if it worked
+    lidarFile = os.path.basename(fpLidar)
+    reprojectPipeline = copy.deepcopy(pipelineTemplate(srsIn, thinStage))
+    reprojectPipeline[0]["filename"] = fpLidar
+    reprojectPipeline[-1]["filename"] = os.path.join(
+        dirLAZ5070, lidarFile[:-4] + ".laz"
+    )
+    try:
+        pdal.Pipeline(json.dumps(reprojectPipeline)).execute()
+    except Exception as err:
+        # Write and error file
+        with open(os.path.join(dirLAZ5070, "_Error.log"), "a") as f:
+            f.write("PDAL Reprojection Error\n")
+            f.write("Check " + lidarFile + "\n")
+            f.write(str(err) + "\n")
+        return str(err)
+    return None
+
+
+def runQAQC(dirLidar, dirQAQC, switches):
+    # Runs FUSION Catalog (exeCatalog) on a directory of lidar files
+    # switches (str) - Catalog switches, e.g. "/rawcounts /coverage"
+    # returns the error message, or None if it worked
+    switches = switches.split()
+    refused = [switch for switch in switches if not catalogSwitch.match(switch)]
+    if len(refused) > 0:
+        return "Catalog switches not allowed: " + " ".join(refused)
+    if not os.path.exists(dirQAQC):
+        os.makedirs(dirQAQC)
+    fpLidarFilePaths = os.path.join(dirQAQC, "lidarFiles.txt")
+    with open(fpLidarFilePaths, "w") as f:
+        for lidarFile in sorted(os.listdir(dirLidar)):
+            f.write(os.path.join(dirLidar, lidarFile))
+            f.write("\n")
+    cmdCatalog = (
+        [exeCatalog] + switches + [fpLidarFilePaths, os.path.join(dirQAQC, "QAQC.csv")]
+    )
+    result = subprocess.run(cmdCatalog)
+    if result.returncode != 0:
+        return "Catalog returned " + str(result.returncode)
+    return None
+
+
+jobFunctions = {"reproject": reprojectFile, "qaqc": runQAQC}
+
+
+def runJob(job):
+    # Runs one job in a worker
+    # returns a dictionary with the job type, its error (None if it
+    # worked), and the run time
+    start = time.time()
+    args = {k: v for k, v in job.items() if k not in ("type", "memEstimate")}
+    try:
+        error = jobFunctions[job["type"]](**args)
+    except Exception as err:
+        error = repr(err)
+    return {"type": job["type"], "error": error, "seconds": time.time() - start}
+
+
+def failedJob(job, err):
+    # Result of a job whose worker died (TerminatedWorkerError) or that could
+    # not be sent to a worker; runJob() catches the errors of the job itself
+    # first line of the message; loky adds several lines of advice
+    error = "worker failed: " + type(err).__name__ + ": " + str(err).split("\n")[0]
+    return {"type": job["type"], "error": error, "seconds": None}
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Service
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+class JobScheduler:
+    # Starts jobs in the workers when a worker is free and their memory fits;
+    # shared by all connections
+    def __init__(self, nWorkers, memBudget=None, memReserve=2, exeCatalog=defaultCatalog):
+        self.nWorkers = nWorkers
+        self.memBudget = memBudget
+        self.reserve = memReserve * 1024 ** 3
+        self.exeCatalog = exeCatalog
+        self.condition = threading.Condition()
+        self.running = 0
+        self.runningMemory = 0
+
+    def budget(self):
+        if self.memBudget is None:
+            # 80% of the RAM free now plus what the running jobs will use
+            return psutil.virtual_memory().available * 0.8 + self.runningMemory
+        return self.memBudget * 1024 ** 3
+
+    def fits(self, memEstimate):
+        if self.running >= self.nWorkers:
+            return False
+        # A job that is too big for the budget still runs, but alone
+        if self.running == 0:
+            return True
+        available = psutil.virtual_memory().available - self.reserve
+        return (
+            self.runningMemory + memEstimate <= self.budget()
+            and memEstimate <= available
+        )
+
+    def executor(self):
+        # The workers; loky starts new ones if a worker died, and idle
+        # workers are kept (timeout=None) so they stay warm
+        return get_reusable_executor(
+            max_workers=self.nWorkers,
+            timeout=None,
+            initializer=warmWorker,
+            initargs=(self.exeCatalog,),
+        )
+
+    def finished(self, memEstimate):
+        with self.condition:
+            self.running -= 1
+            self.runningMemory -= memEstimate
+            self.condition.notify_all()
+
+    def run(self, jobs):
+        # Runs a list of jobs and returns their results in the same order
+        # Start the largest jobs first so they do not end up running alone
+        order = sorted(range(len(jobs)), key=lambda i: -jobs[i].get("memEstimate", 0))
+        futures = {}
+        results = {}
+        for i in order:
+            memEstimate = jobs[i].get("memEstimate", 0)
+            with self.condition:
+                # check free RAM again every few seconds while jobs are waiting
+                while not self.fits(memEstimate):
+                    self.condition.wait(timeout=5)
+                self.running += 1
+                self.runningMemory += memEstimate
+            try:
+                futures[i] = self.executor().submit(runJob, jobs[i])
+            except Exception as err:
+                # e.g. the workers died between executor() and submit()
+                self.finished(memEstimate)
+                results[i] = failedJob(jobs[i], err)
+                continue
+            futures[i].add_done_callback(lambda f, m=memEstimate: self.finished(m))
+        for i, future in futures.items():
+            try:
+                results[i] = future.result()
+            except Exception as err:
+                results[i] = failedJob(jobs[i], err)
+        return [results[i] for i in range(len(jobs))]
+
+    def close(self):
+        self.executor().shutdown(wait=True)
+
+
+def writeServiceKey(key, fpKey=fpServiceKey):
+    # Saves the authentication key in a file only the current user can read
+    dirKey = os.path.dirname(fpKey)
+    if not os.path.exists(dirKey):
+        os.makedirs(dirKey, mode=0o700)
+    # a new file, so it is created with these permissions
+    if os.path.exists(fpKey):
+        os.remove(fpKey)
+    fd = os.open(
+        fpKey, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0o600
+    )
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+
+
+def readServiceKey(fpKey=fpServiceKey):
+    # Authentication key of the running service
+    with open(fpKey, "rb") as f:
+        return f.read()
+
+
+def handleConnection(conn, scheduler, stopping, address, authkey):
+    # Messages are ("ping",), ("run", jobs), or ("stop",)
+    try:
+        message = conn.recv()
+        if message[0] == "run":
+            conn.send(scheduler.run(message[1]))
+        elif message[0] == "stop":
+            stopping.set()
+            conn.send("stopping")
+            # wake up the accept() in serve()
+            Client(address, authkey=authkey).close()
+        else:
+            conn.send("ok")
+    except (EOFError, OSError):
+        # the client went away; its jobs still finish
+        pass
+    finally:
+        conn.close()
+
+
+def serve(nWorkers, memBudget=None, exeCatalog=defaultCatalog, address=serviceAddress):
+    # Runs the service until it is stopped
+    # exeCatalog (str) - FUSION Catalog.exe used by the QAQC jobs
+    authkey = os.urandom(32)
+    # fails if the service is already running; its key is left as it is
+    listener = Listener(address, authkey=authkey)
+    writeServiceKey(authkey)
+    scheduler = JobScheduler(nWorkers, memBudget, exeCatalog=exeCatalog)
+    stopping = threading.Event()
+    print("PDAL worker service on " + address[0] + ":" + str(address[1]))
+    print("\t" + str(nWorkers) + " workers")
+    print("\t" + exeCatalog)
+    try:
+        while not stopping.is_set():
+            try:
+                conn = listener.accept()
+            except Exception:
+                # e.g. a client with the wrong authentication key
+                continue
+            threading.Thread(
+                target=handleConnection,
+                args=(conn, scheduler, stopping, address, authkey),
+                daemon=True,
+            ).start()
+    finally:
+        listener.close()
+        scheduler.close()
+    print("PDAL worker service stopped")
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Client
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+def sendMessage(message, address=serviceAddress, fpKey=fpServiceKey):
+    conn = Client(address, authkey=readServiceKey(fpKey))
+    try:
+        conn.send(message)
+        return conn.recv()
+    finally:
+        conn.close()
+
+
+def serviceIsRunning(address=serviceAddress, fpKey=fpServiceKey):
+    # False also if there is no key file, or it is from an earlier service
+    try:
+        return sendMessage(("ping",), address, fpKey) == "ok"
+    except (OSError, EOFError, multiprocessing.AuthenticationError):
+        return False
+
+
+def startService(nWorkers, memBudget=None, exeCatalog=None, timeout=120):
+    # Starts the service in the background if it is not running
+    # The service keeps running after the calling script ends
+    # exeCatalog (str) - FUSION Catalog.exe used by the QAQC jobs; None uses
+    #   defaultCatalog
+    if serviceIsRunning():
+        return
+    cmd = [sys.executable, os.path.abspath(__file__), "--workers", str(nWorkers)]
+    if memBudget is not None:
+        cmd += ["--mem-budget", str(memBudget)]
+    if exeCatalog is not None:
+        cmd += ["--catalog", exeCatalog]
+    if sys.platform == "win32":
+        subprocess.Popen(
+            cmd,
+            creationflags=subprocess.CREATE_NEW_PROCESS_GROUP
+            | subprocess.CREATE_NEW_CONSOLE,
+        )
+    else:
+        subprocess.Popen(cmd, start_new_session=True)
+    waited = 0
+    while not serviceIsRunning():
+        if waited >= timeout:
+            raise RuntimeError("The PDAL worker service did not start")
+        time.sleep(1)
+        waited += 1
+
+
+def stopService():
+    # Stops the service after the jobs it is running have finished
+    if serviceIsRunning():
+        sendMessage(("stop",))
+
+
+def submitJobs(jobs):
+    # Runs jobs in the service and waits for them
+    # jobs (list) - dictionaries; see reprojectJob() and qaqcJob()
+    # returns a list of results (see runJob()) in the same order as jobs
+    if len(jobs) == 0:
+        return []
+    return sendMessage(("run", jobs))
+
+
+def reprojectJob(fpLidar, dirLAZ5070, srsIn=None, thinStage=None, memEstimate=0):
+    return {
+        "type": "reproject",
+        "fpLidar": fpLidar,
+        "dirLAZ5070": dirLAZ5070,
+        "srsIn": srsIn,
+        "thinStage": thinStage,
+        "memEstimate": memEstimate,
+    }
+
+
+def qaqcJob(dirLidar, dirQAQC, switches, memEstimate=0):
+    # Catalog.exe is set when the service starts (see startService())
+    return {
+        "type": "qaqc",
+        "dirLidar": dirLidar,
+        "dirQAQC": dirQAQC,
+        "switches": switches,
+        "memEstimate": memEstimate,
+    }
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Run
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PDAL worker service")
+    parser.add_argument("--workers", type=int, default=26, help="number of workers")
+    parser.add_argument(
+        "--mem-budget",
+        type=float,
+        default=None,
+        help="GB the running jobs may use; default is 80%% of free RAM",
+    )
+    parser.add_argument(
+        "--catalog",
+        default=defaultCatalog,
+        help="FUSION Catalog.exe used by the QAQC jobs",
+    )
+    parser.add_argument("--stop", action="store_true", help="stop the service")
+    args = parser.parse_args()
+
+    if args.stop:
+        stopService()
+    else:
+        # use the functions of the module, not __main__, so the jobs are sent
+        # to the workers by name and the workers keep their pipelines and PROJ
+        import pdalWorkerService
+
+        pdalWorkerService.serve(args.workers, args.mem_budget, args.catalog)
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+"""
+Name:    pointCache.py
+Purpose: Filters and height-normalizes each buffered tile once
+Author:  PA Fekety, Colorado State University, patrick.fekety@colostate.edu
+Date:    2021.03.30
+
+"""
+
+"""
+Notes:
+  tile.bat makes FUSION apply CLASSOPTION (/class:~7,9), OUTLIER, and the
+    ground (DTMSPEC) separately in every gridmetrics and CanopyModel run.
+    This does it once per buffered tile (a processing block) and saves the
+    result for Python engines such as 08_CreateCellMetrics.py. FUSION does
+    not read the cache, so building it is an extra read of the lidar files;
+    only build it when an engine uses it.
+  The cache of a tile is a folder with one .npy file per column (x, y,
+    height, returnNumber, numberOfReturns, intensity, classification) and a
+    tile.json describing the tile. Columns are read with np.load(mmap_mode)
+    so an engine only touches the columns it needs.
+  Heights are the point elevation minus the ground surface, interpolated
+    bilinearly from the ground grid points. Points without ground are
+    dropped, as are points outside the outlier range.
+  A tile is rebuilt only when its lidar files or the ground models that
+    overlap it are newer than its cache (or the set of them changed).
+"""
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Import packages
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+import os
+import json
+import shutil
+import numpy as np
+import pdal
+import rasterio as rio
+import rasterio.windows
+from lidarFunctions import (
+    readLasHeader,
+    extentsIntersect,
+    taskMemoryOverhead,
+    pointMemoryMultiplier,
+)
+from fusionDtm import readDtm, dtmWindow, dtmToFloat
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Assign Variables
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Columns saved for each point and their data types
+cacheColumns = {
+    "x": np.float64,
+    "y": np.float64,
+    "height": np.float32,
+    "returnNumber": np.uint8,
+    "numberOfReturns": np.uint8,
+    "intensity": np.uint16,
+    "classification": np.uint8,
+}
+
+# PDAL dimension of each column
+pdalDimensions = {
+    "x": "X",
+    "y": "Y",
+    "returnNumber": "ReturnNumber",
+    "numberOfReturns": "NumberOfReturns",
+    "intensity": "Intensity",
+    "classification": "Classification",
+}
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Ground
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+def bilinear(grid, xFirst, yTop, spacing, x, y):
+    # Bilinear interpolation of a north-up grid of points
+    # xFirst, yTop - coordinates of the upper left grid point
+    # returns NaN outside the grid or next to NaN grid points
+    col = (x - xFirst) / spacing
+    row = (yTop - y) / spacing
+    col0 = np.floor(col).astype(np.int64)
+    row0 = np.floor(row).astype(np.int64)
+    inside = (
+        (col0 >= 0)
+        & (row0 >= 0)
+        & (col0 < grid.shape[1] - 1)
+        & (row0 < grid.shape[0] - 1)
+    )
+    z = np.full(x.shape, np.nan)
+    c0 = col0[inside]
+    r0 = row0[inside]
+    dc = col[inside] - c0
+    dr = row[inside] - r0
+    z[inside] = (
+        grid[r0, c0] * (1 - dc) * (1 - dr)
+        + grid[r0, c0 + 1] * dc * (1 - dr)
+        + grid[r0 + 1, c0] * (1 - dc) * dr
+        + grid[r0 + 1, c0 + 1] * dc * dr
+    )
+    return z
+
+
+def openGround(fpDtms, bufferedExtent):
+    # Opens the ground models that overlap a buffered tile
+    # Each header is read once per tile; the grids are read in windows by
+    # sampleGround()
+    # fpDtms (list) - ground models; FUSION .dtm or any format GDAL can read
+    # returns a list of dictionaries; close them with closeGround()
+    grounds = []
+    for fpDtm in fpDtms:
+        if fpDtm.lower().endswith(".dtm"):
+            grid, header = readDtm(fpDtm)
+            spacing = header["columnSpacing"]
+            # extent of the grid points
+            extent = (header["originX"], header["originY"], header["maxX"], header["maxY"])
+            ground = {"file": fpDtm, "grid": grid, "header": header}
+        else:
+            src = rio.open(fpDtm)
+            spacing = src.res[0]
+            b = src.bounds
+            extent = (b.left, b.bottom, b.right, b.top)
+            ground = {"file": fpDtm, "src": src}
+        padded = (
+            bufferedExtent[0] - spacing,
+            bufferedExtent[1] - spacing,
+            bufferedExtent[2] + spacing,
+            bufferedExtent[3] + spacing,
+        )
+        if not extentsIntersect(extent, padded):
+            if "src" in ground:
+                ground["src"].close()
+            continue
+        ground["spacing"] = spacing
+        ground["extent"] = extent
+        grounds.append(ground)
+    return grounds
+
+
+def closeGround(grounds):
+    for ground in grounds:
+        if "src" in ground:
+            ground["src"].close()
+
+
+def sampleGround(grounds, x, y):
+    # Ground elevation at each point
+    # grounds (list) - output of openGround(); only the part of each model
+    #   around the points is read
+    ground = np.full(x.shape, np.nan)
+    if len(x) == 0:
+        return ground
+    bounds = (x.min(), y.min(), x.max(), y.max())
+    for g in grounds:
+        spacing = g["spacing"]
+        padded = (
+            bounds[0] - spacing,
+            bounds[1] - spacing,
+            bounds[2] + spacing,
+            bounds[3] + spacing,
+        )
+        if not extentsIntersect(g["extent"], padded):
+            continue
+        if "grid" in g:
+            header = g["header"]
+            rows, cols, colStart, pointStart = dtmWindow(header, padded)
+            window = g["grid"][rows, cols]
+            if window.size == 0:
+                continue
+            grid = dtmToFloat(window)
+            xFirst = header["originX"] + colStart * spacing
+            yTop = header["originY"] + (pointStart + window.shape[0] - 1) * header[
+                "pointSpacing"
+            ]
+        else:
+            src = g["src"]
+            window = rio.windows.from_bounds(*padded, transform=src.transform)
+            window = window.round_offsets(op="floor").round_lengths(op="ceil")
+            window = window.intersection(rio.windows.Window(0, 0, src.width, src.height))
+            grid = src.read(1, window=window).astype(np.float64)
+            if src.nodata is not None:
+                grid[grid == src.nodata] = np.nan
+            left, bottom, right, top = rio.windows.bounds(window, src.transform)
+            # grid points are the cell centers
+            xFirst = left + spacing / 2
+            yTop = top - spacing / 2
+        missing = np.isnan(ground)
+        ground[missing] = bilinear(grid, xFirst, yTop, spacing, x[missing], y[missing])
+    return ground
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Cache
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+def findTileFiles(fpLidars, bufferedExtent):
+    # Lidar files whose header extent overlaps the buffered tile
+    tileFiles = []
+    for fpLidar in fpLidars:
+        header = readLasHeader(fpLidar)
+        extent = (header["minX"], header["minY"], header["maxX"], header["maxY"])
+        if extentsIntersect(extent, bufferedExtent):
+            tileFiles.append(fpLidar)
+    return tileFiles
+
+
+def estimateCacheMemory(fpLidars):
+    # Estimated peak memory (bytes) of buildTileCache()
+    # Files are read one at a time, but the cached columns of every file are
+    # held until the tile is saved
+    largest = 0
+    cachedBytes = 0
+    pointBytes = sum(np.dtype(dtype).itemsize for dtype in cacheColumns.values())
+    for fpLidar in fpLidars:
+        header = readLasHeader(fpLidar)
+        largest = max(largest, header["nPoints"] * header["recordLength"])
+        cachedBytes += header["nPoints"] * pointBytes
+    return int(largest * pointMemoryMultiplier + cachedBytes * 2 + taskMemoryOverhead)
+
+
+def cacheIsCurrent(dirTile, fpSources):
+    # True if the cache exists and is newer than all of its sources
+    fpMeta = os.path.join(dirTile, "tile.json")
+    if not os.path.exists(fpMeta):
+        return False
+    with open(fpMeta) as f:
+        meta = json.load(f)
+    if sorted(meta["sources"]) != sorted(fpSources):
+        return False
+    cacheTime = os.path.getmtime(fpMeta)
+    return all(os.path.getmtime(fp) < cacheTime for fp in fpSources)
+
+
+def buildTileCache(
+    tileName,
+    bufferedExtent,
+    fpLidars,
+    fpDtms,
+    dirCache,
+    excludeClasses=(7, 9),
+    outlier=(-30, 150),
+):
+    # Filters and height-normalizes the points of one buffered tile
+    # tileName (str) - name of the tile (e.g., BLOCK1)
+    # bufferedExtent (tuple) - (minX, minY, maxX, maxY) including the buffer
+    # fpLidars (list) - lidar files (LAZ5070) that overlap the tile
+    # fpDtms (list) - ground models (DTMSPEC); only the ones that overlap the
+    #   tile are used and recorded as sources
+    # dirCache (str) - the tile is saved in dirCache\tileName
+    # excludeClasses (tuple) - classes that are dropped (CLASSOPTION)
+    # outlier (tuple) - heights outside this range are dropped (OUTLIER)
+    # returns the number of points in the cache
+    dirTile = os.path.join(dirCache, tileName)
+    grounds = openGround(fpDtms, bufferedExtent)
+    try:
+        fpSources = list(fpLidars) + [g["file"] for g in grounds]
+        if cacheIsCurrent(dirTile, fpSources):
+            with open(os.path.join(dirTile, "tile.json")) as f:
+                return json.load(f)["nPoints"]
+        return writeTileCache(
+            tileName, dirTile, bufferedExtent, fpLidars, grounds, fpSources,
+            excludeClasses, outlier,
+        )
+    finally:
+        closeGround(grounds)
+
+
+def writeTileCache(
+    tileName, dirTile, bufferedExtent, fpLidars, grounds, fpSources, excludeClasses, outlier
+):
+    # buildTileCache() for a tile whose cache is missing or out of date
+
+    columns = {name: [] for name in cacheColumns}
+    bounds = (
+        "(["
+        + str(bufferedExtent[0])
+        + ","
+        + str(bufferedExtent[2])
+        + "],["
+        + str(bufferedExtent[1])
+        + ","
+        + str(bufferedExtent[3])
+        + "])"
+    )
+    for fpLidar in fpLidars:
+        cachePipeline = [
+            {"filename": fpLidar, "type": "readers.las"},
+            {"type": "filters.crop", "bounds": bounds},
+        ]
+        pipeline = pdal.Pipeline(json.dumps(cachePipeline))
+        pipeline.execute()
+        points = pipeline.arrays[0]
+        if len(points) == 0:
+            continue
+
+        keep = ~np.isin(points["Classification"], excludeClasses)
+        points = points[keep]
+        ground = sampleGround(grounds, points["X"], points["Y"])
+        height = points["Z"] - ground
+        keep = ~np.isnan(height) & (height >= outlier[0]) & (height <= outlier[1])
+        points = points[keep]
+
+        columns["height"].append(height[keep])
+        for name, dimension in pdalDimensions.items():
+            columns[name].append(points[dimension])
+
+    # replace the old cache
+    if os.path.exists(dirTile):
+        shutil.rmtree(dirTile)
+    os.makedirs(dirTile)
+    nPoints = 0
+    for name, dtype in cacheColumns.items():
+        if len(columns[name]) > 0:
+            values = np.concatenate(columns[name]).astype(dtype)
+        else:
+            values = np.empty(0, dtype=dtype)
+        nPoints = len(values)
+        np.save(os.path.join(dirTile, name + ".npy"), values)
+    del columns
+
+    meta = {
+        "tileName": tileName,
+        "bufferedExtent": list(bufferedExtent),
+        "nPoints": nPoints,
+        "excludeClasses": list(excludeClasses),
+        "outlier": list(outlier),
+        "sources": fpSources,
+    }
+    # tile.json is written last; it marks the cache as complete
+    with open(os.path.join(dirTile, "tile.json"), "w") as f:
+        json.dump(meta, f, indent=1)
+    return nPoints
+
+
+def readTileCache(dirTile, columns=None):
+    # Opens the cache of a tile
+    # columns (list) - columns to open; None opens all of them
+    # returns a dictionary of memory-mapped arrays and the tile description
+    with open(os.path.join(dirTile, "tile.json")) as f:
+        meta = json.load(f)
+    if columns is None:
+        columns = list(cacheColumns)
+    points = {
+        name: np.load(os.path.join(dirTile, name + ".npy"), mmap_mode="r")
+        for name in columns
+    }
+    return points, meta
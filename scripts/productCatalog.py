@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+"""
+Name:    productCatalog.py
+Purpose: Indexes the published products of every project and mosaics them
+         across projects without merging the files
+Author:  PA Fekety, Colorado State University, patrick.fekety@colostate.edu
+Date:    2021.04.13
+
+"""
+
+"""
+Notes:
+  03_CreateGriddedMetrics.py publishes each project in
+    dirFinalProducts\<project>\FusionOutputs\<group>\<metric>.asc
+  The catalog is a CSV with one row per published raster: project,
+    acquisition year (the 4 digits at the end of the project name), group,
+    metric, file, extent, cell size, and NoData.
+  Where projects overlap, the project with the highest priority is used.
+    "newest" prefers the latest acquisition year, "oldest" the earliest, and a
+    list of project names gives the order explicitly (first is highest).
+  writeMosaicVRT() writes a GDAL VRT per metric that QGIS/ArcGIS/GDAL open as
+    one raster. readMosaicWindow() reads a window and only opens the projects
+    that intersect it. writeMosaicCOG() materializes a metric: windows are
+    read in parallel and written by one process, then the result is copied
+    to a Cloud Optimized GeoTIFF (GDAL >= 3.1).
+"""
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Import packages
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+import os
+import re
+import csv
+import math
+import numpy as np
+import rasterio as rio
+import rasterio.shutil
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from rasterio.warp import reproject
+from rasterio.windows import Window
+from xml.sax.saxutils import escape
+from joblib import Parallel, delayed
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Catalog
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Folders of FusionOutputs that are cataloged
+productGroups = [
+    "TopoMetrics",
+    "HeightMetrics",
+    "IntensityMetrics",
+    "CanopyMetrics",
+    "StrataMetrics",
+]
+
+catalogFields = [
+    "project",
+    "year",
+    "group",
+    "metric",
+    "file",
+    "minX",
+    "minY",
+    "maxX",
+    "maxY",
+    "cellSize",
+    "nodata",
+]
+
+
+def acquisitionYear(project):
+    # Year at the end of a project name (e.g., CO_PitkinCo_2016); None if missing
+    match = re.search(r"_(\d{4})$", project)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+def describeProduct(fpRaster, project, group):
+    # One catalog row
+    with rio.open(fpRaster) as src:
+        bounds = src.bounds
+        return {
+            "project": project,
+            "year": acquisitionYear(project),
+            "group": group,
+            "metric": os.path.splitext(os.path.basename(fpRaster))[0],
+            "file": fpRaster,
+            "minX": bounds.left,
+            "minY": bounds.bottom,
+            "maxX": bounds.right,
+            "maxY": bounds.top,
+            "cellSize": src.res[0],
+            "nodata": src.nodata,
+        }
+
+
+def buildProductCatalog(dirFinalProducts, groups=None, nCores=8):
+    # Catalog of the published rasters of every project
+    # dirFinalProducts (str) - dirFinalProducts of 03_CreateGriddedMetrics.py
+    # groups (list) - folders of FusionOutputs; None uses productGroups
+    # returns a list of catalog rows
+    if groups is None:
+        groups = productGroups
+    products = []
+    for project in sorted(os.listdir(dirFinalProducts)):
+        dirOutputs = os.path.join(dirFinalProducts, project, "FusionOutputs")
+        if not os.path.isdir(dirOutputs):
+            continue
+        for group in groups:
+            dirGroup = os.path.join(dirOutputs, group)
+            if not os.path.isdir(dirGroup):
+                continue
+            for f in sorted(os.listdir(dirGroup)):
+                if f.lower().endswith((".asc", ".tif", ".img")):
+                    products.append((os.path.join(dirGroup, f), project, group))
+    # only the headers are read, so threads are enough
+    nCores = max(min(nCores, len(products)), 1)
+    return Parallel(n_jobs=nCores, prefer="threads")(
+        delayed(describeProduct)(*product) for product in products
+    )
+
+
+def writeProductCatalog(catalog, fpCatalog):
+    with open(fpCatalog, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=catalogFields)
+        writer.writeheader()
+        for row in catalog:
+            writer.writerow(row)
+
+
+def readProductCatalog(fpCatalog):
+    catalog = []
+    with open(fpCatalog, newline="") as f:
+        for row in csv.DictReader(f):
+            for field in ("minX", "minY", "maxX", "maxY", "cellSize"):
+                row[field] = float(row[field])
+            row["year"] = int(row["year"]) if row["year"] != "" else None
+            row["nodata"] = float(row["nodata"]) if row["nodata"] != "" else None
+            catalog.append(row)
+    return catalog
+
+
+def sortByPriority(rows, priority="newest"):
+    # Rows ordered from the highest to the lowest priority
+    # priority - "newest", "oldest", or a list of project names
+    if isinstance(priority, (list, tuple)):
+        order = {project: i for i, project in enumerate(priority)}
+        return sorted(rows, key=lambda r: (order.get(r["project"], len(order)), r["project"]))
+    # projects without a year go last
+    if priority == "newest":
+        return sorted(
+            rows, key=lambda r: (r["year"] is None, -(r["year"] or 0), r["project"])
+        )
+    if priority == "oldest":
+        return sorted(
+            rows, key=lambda r: (r["year"] is None, r["year"] or 0, r["project"])
+        )
+    raise ValueError("priority must be 'newest', 'oldest', or a list of projects")
+
+
+def selectMetric(catalog, metric, priority="newest"):
+    # Rows of one metric ordered by priority
+    rows = [row for row in catalog if row["metric"] == metric]
+    if len(rows) == 0:
+        raise ValueError(metric + " is not in the catalog")
+    cellSizes = set(row["cellSize"] for row in rows)
+    if len(cellSizes) > 1:
+        raise ValueError(metric + " has more than one cell size: " + str(cellSizes))
+    return sortByPriority(rows, priority)
+
+
+def mosaicGrid(rows):
+    # Transform, width, and height of the grid covering all rows
+    cellSize = rows[0]["cellSize"]
+    minX = min(row["minX"] for row in rows)
+    maxY = max(row["maxY"] for row in rows)
+    width = int(math.ceil((max(row["maxX"] for row in rows) - minX) / cellSize - 1e-6))
+    height = int(math.ceil((maxY - min(row["minY"] for row in rows)) / cellSize - 1e-6))
+    return from_origin(minX, maxY, cellSize, cellSize), width, height
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Virtual Mosaic
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+def writeMosaicVRT(rows, fpVrt, nodata=-9999):
+    # Writes a GDAL VRT of one metric
+    # rows (list) - output of selectMetric(); the first row has priority
+    transform, width, height = mosaicGrid(rows)
+    cellSize = transform.a
+    with rio.open(rows[0]["file"]) as src:
+        crs = src.crs
+        dtype = src.dtypes[0]
+    dataType = {
+        "uint8": "Byte",
+        "int16": "Int16",
+        "uint16": "UInt16",
+        "int32": "Int32",
+        "uint32": "UInt32",
+        "float32": "Float32",
+        "float64": "Float64",
+    }[dtype]
+
+    lines = ['<VRTDataset rasterXSize="' + str(width) + '" rasterYSize="' + str(height) + '">']
+    if crs is not None:
+        lines.append("  <SRS>" + escape(crs.to_wkt()) + "</SRS>")
+    lines.append(
+        "  <GeoTransform>"
+        + ", ".join(repr(v) for v in (transform.c, cellSize, 0.0, transform.f, 0.0, -cellSize))
+        + "</GeoTransform>"
+    )
+    lines.append('  <VRTRasterBand dataType="' + dataType + '" band="1">')
+    lines.append("    <NoDataValue>" + str(nodata) + "</NoDataValue>")
+    # later sources are drawn over earlier ones, so the highest priority is last
+    for row in reversed(rows):
+        with rio.open(row["file"]) as src:
+            srcWidth = src.width
+            srcHeight = src.height
+        xOff = (row["minX"] - transform.c) / cellSize
+        yOff = (transform.f - row["maxY"]) / cellSize
+        lines.append("    <ComplexSource>")
+        lines.append(
+            '      <SourceFilename relativeToVRT="0">'
+            + escape(os.path.abspath(row["file"]))
+            + "</SourceFilename>"
+        )
+        lines.append("      <SourceBand>1</SourceBand>")
+        lines.append(
+            '      <SrcRect xOff="0" yOff="0" xSize="'
+            + str(srcWidth)
+            + '" ySize="'
+            + str(srcHeight)
+            + '" />'
+        )
+        lines.append(
+            '      <DstRect xOff="'
+            + repr(xOff)
+            + '" yOff="'
+            + repr(yOff)
+            + '" xSize="'
+            + str(srcWidth)
+            + '" ySize="'
+            + str(srcHeight)
+            + '" />'
+        )
+        if row["nodata"] is not None:
+            # NoData cells do not cover lower priority projects
+            lines.append("      <NODATA>" + str(row["nodata"]) + "</NODATA>")
+        lines.append("    </ComplexSource>")
+    lines.append("  </VRTRasterBand>")
+    lines.append("</VRTDataset>")
+    with open(fpVrt, "w") as f:
+        f.write("\n".join(lines))
+        f.write("\n")
+
+
+def readMosaicWindow(rows, bounds, nodata=-9999):
+    # Reads a window of one metric across projects
+    # rows (list) - output of selectMetric(); the first row has priority
+    # bounds (tuple) - (minX, minY, maxX, maxY), on the grid of the metric
+    # returns (array, transform); cells without data are nodata
+    cellSize = rows[0]["cellSize"]
+    width = int(round((bounds[2] - bounds[0]) / cellSize))
+    height = int(round((bounds[3] - bounds[1]) / cellSize))
+    transform = from_origin(bounds[0], bounds[3], cellSize, cellSize)
+    mosaic = np.full((height, width), np.nan, dtype=np.float64)
+    for row in rows:
+        if not (
+            row["minX"] < bounds[2]
+            and row["maxX"] > bounds[0]
+            and row["minY"] < bounds[3]
+            and row["maxY"] > bounds[1]
+        ):
+            continue
+        part = np.full((height, width), np.nan, dtype=np.float64)
+        with rio.open(row["file"]) as src:
+            # .asc files without a .prj have no CRS; the products are EPSG:5070
+            crs = src.crs if src.crs is not None else "EPSG:5070"
+            reproject(
+                source=rio.band(src, 1),
+                destination=part,
+                src_transform=src.transform,
+                src_crs=crs,
+                src_nodata=src.nodata,
+                dst_transform=transform,
+                dst_crs=crs,
+                dst_nodata=np.nan,
+                resampling=Resampling.nearest,
+            )
+        fill = np.isnan(mosaic) & ~np.isnan(part)
+        mosaic[fill] = part[fill]
+        if not np.isnan(mosaic).any():
+            break
+    mosaic[np.isnan(mosaic)] = nodata
+    return mosaic, transform
+
+
+def writeMosaicCOG(rows, fpOut, nCores=8, blockSize=2048, nodata=-9999):
+    # Materializes one metric as a Cloud Optimized GeoTIFF
+    # Windows of blockSize cells are read in parallel threads, nCores at a
+    # time, and written by this process only
+    transform, width, height = mosaicGrid(rows)
+    cellSize = transform.a
+    with rio.open(rows[0]["file"]) as src:
+        crs = src.crs if src.crs is not None else "EPSG:5070"
+    fpTemp = os.path.splitext(fpOut)[0] + "_temp.tif"
+    profile = {
+        "driver": "GTiff",
+        "width": width,
+        "height": height,
+        "count": 1,
+        "dtype": "float32",
+        "crs": crs,
+        "transform": transform,
+        "nodata": nodata,
+        "tiled": True,
+        "blockxsize": 512,
+        "blockysize": 512,
+        "compress": "deflate",
+        "BIGTIFF": "IF_SAFER",
+    }
+    windows = [
+        Window(col, row, min(blockSize, width - col), min(blockSize, height - row))
+        for row in range(0, height, blockSize)
+        for col in range(0, width, blockSize)
+    ]
+
+    def windowBounds(window):
+        minX = transform.c + window.col_off * cellSize
+        maxY = transform.f - window.row_off * cellSize
+        return (minX, maxY - window.height * cellSize, minX + window.width * cellSize, maxY)
+
+    with rio.open(fpTemp, "w", **profile) as dst:
+        for i in range(0, len(windows), nCores):
+            batch = windows[i : i + nCores]
+            parts = Parallel(n_jobs=len(batch), prefer="threads")(
+                delayed(readMosaicWindow)(rows, windowBounds(window), nodata)
+                for window in batch
+            )
+            for window, (part, _) in zip(batch, parts):
+                dst.write(part.astype(np.float32), 1, window=window)
+
+    with rio.Env() as env:
+        hasCOG = "COG" in env.drivers()
+    if hasCOG:
+        rio.shutil.copy(fpTemp, fpOut, driver="COG", compress="deflate", BIGTIFF="IF_SAFER")
+        os.remove(fpTemp)
+    else:
+        # older GDAL; keep the tiled GeoTIFF and add overviews
+        with rio.open(fpTemp, "r+") as dst:
+            dst.build_overviews([2, 4, 8, 16, 32], Resampling.average)
+        os.replace(fpTemp, fpOut)
@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+"""
+Name:    topoMetrics.py
+Purpose: Computes multi-scale topographic metrics from the ground DTM
+Author:  PA Fekety, Colorado State University, patrick.fekety@colostate.edu
+Date:    2021.03.09
+
+"""
+
+"""
+Notes:
+  This replaces the FUSION topo passes (DOTOPO, TOPOCELLSIZE,
+    MULTITOPOWINDOWSIZES, and MULTITPIWINDOWSIZES in Basic_setup.bat).
+    Set DOTOPO=FALSE in Basic_setup.bat when using it.
+  The ground DTM is read once per tile (plus a halo) and every window size
+    is computed from that read. The cell elevations (for TPI and the
+    single-scale metrics) are averaged from the same read.
+  The single-scale layers of FUSION TopoMetrics (TOPO_slope, TOPO_aspect,
+    TOPO_profilecurv, TOPO_plancurv, TOPO_sri, and TOPO_curvature at the
+    grid cell size) are computed from the neighboring cells, so the
+    published products are the same as with DOTOPO=TRUE.
+  Slope, aspect, curvature, and SRI for a window size are computed from the
+    DTM smoothed by a box filter the size of the window. The derivatives are
+    taken across the window (Zevenbergen and Thorne 1987), then averaged to
+    the topo cell. TPI is the cell elevation minus the mean elevation of the
+    window. Box filters are separable running sums, so the cost does not
+    depend on the window size.
+  Aspect is degrees clockwise from north; flat cells are -1.
+  Curvatures are 1/100 m (the same units as ArcGIS).
+  SRI follows Keating et al. (2007) and ranges from 0 to 2:
+    SRI = 1 + cos(latitude) * cos(slope)
+            + sin(latitude) * sin(slope) * cos(aspect - 180)
+"""
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Import packages
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+import os
+import math
+import numpy as np
+import rasterio as rio
+from rasterio.transform import from_origin
+from rasterio.warp import reproject, transform, Resampling
+from joblib import Parallel, delayed
+from fusionDtm import readDtmHeader, readDtmWindow, dtmToFloat, dtmTransform
+
+
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Define Functions
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+def calculateLatitude(xMid, yMid):
+    # Latitude of a point in EPSG:5070; same as calculateLatitude() in
+    # 02_CreateAPSettingsPRP.R
+    lon, lat = transform("EPSG:5070", "EPSG:4269", [xMid], [yMid])
+    return round(lat[0], 2)
+
+
+def formatIdentifier(size, units="METERS"):
+    # FUSION style file identifier, e.g. 1.5 -> 1p5METERS
+    if float(size) == int(size):
+        size = int(size)
+    return str(size).replace(".", "p") + units
+
+
+def oddCells(size, cellSize):
+    # Number of cells (odd, at least 3) that spans a window
+    n = int(round(size / cellSize))
+    if n % 2 == 0:
+        n += 1
+    return max(n, 3)
+
+
+def boxSum(a, n):
+    # Sum of an n x n moving window (n is odd); zeros outside the array
+    # Two cumulative sums (one per axis) make this separable
+    r = n // 2
+    a = np.pad(a, r, mode="constant")
+    c = np.cumsum(a, axis=0)
+    c = np.concatenate([np.zeros((1, c.shape[1])), c], axis=0)
+    a = c[n:] - c[:-n]
+    c = np.cumsum(a, axis=1)
+    c = np.concatenate([np.zeros((c.shape[0], 1)), c], axis=1)
+    return c[:, n:] - c[:, :-n]
+
+
+def boxMean(z, n):
+    # Mean of an n x n moving window that ignores NaN
+    valid = ~np.isnan(z)
+    total = boxSum(np.where(valid, z, 0.0), n)
+    count = boxSum(valid.astype(np.float64), n)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = total / count
+    mean[count < 0.5] = np.nan
+    return mean
+
+
+def blockMean(z, factor):
+    # Averages factor x factor blocks of cells; ignores NaN
+    rows = z.shape[0] // factor
+    cols = z.shape[1] // factor
+    z = z[: rows * factor, : cols * factor].reshape(rows, factor, cols, factor)
+    with np.errstate(invalid="ignore"):
+        count = np.sum(~np.isnan(z), axis=(1, 3))
+        total = np.nansum(z, axis=(1, 3))
+        mean = total / count
+    mean[count == 0] = np.nan
+    return mean
+
+
+def readDtmMosaic(fpDtms, bounds, cellSize):
+    # Reads the ground DTMs that overlap bounds onto a grid of cellSize
+    # Cells are averaged when cellSize is larger than the DTM cells
+    # fpDtms (list) - file paths of the DTMs (FUSION .dtm or any format GDAL
+    #   can read)
+    # bounds (tuple) - (minX, minY, maxX, maxY) aligned to cellSize
+    # returns a float64 array with NaN where there is no data
+    cols = int(round((bounds[2] - bounds[0]) / cellSize))
+    rows = int(round((bounds[3] - bounds[1]) / cellSize))
+    dstTransform = from_origin(bounds[0], bounds[3], cellSize, cellSize)
+    mosaic = np.full((rows, cols), np.nan)
+    for fpDtm in fpDtms:
+        if fpDtm.lower().endswith(".dtm"):
+            dtm = readFusionDtm(fpDtm, bounds, dstTransform, rows, cols)
+            if dtm is not None:
+                fill = np.isnan(mosaic)
+                mosaic[fill] = dtm[fill]
+            continue
+        with rio.open(fpDtm) as src:
+            b = src.bounds
+            if not (
+                b.left < bounds[2]
+                and b.right > bounds[0]
+                and b.bottom < bounds[3]
+                and b.top > bounds[1]
+            ):
+                continue
+            dtm = np.full((rows, cols), np.nan)
+            reproject(
+                source=rio.band(src, 1),
+                destination=dtm,
+                src_nodata=src.nodata,
+                dst_transform=dstTransform,
+                dst_crs=src.crs,
+                dst_nodata=np.nan,
+                resampling=Resampling.average,
+            )
+        fill = np.isnan(mosaic)
+        mosaic[fill] = dtm[fill]
+    return mosaic
+
+
+def readFusionDtm(fpDtm, bounds, dstTransform, rows, cols):
+    # readDtmMosaic() for FUSION .dtm files; only the window that overlaps
+    # bounds is read from the memmap
+    header = readDtmHeader(fpDtm)
+    halfX = header["columnSpacing"] / 2
+    halfY = header["pointSpacing"] / 2
+    if not (
+        header["originX"] - halfX < bounds[2]
+        and header["maxX"] + halfX > bounds[0]
+        and header["originY"] - halfY < bounds[3]
+        and header["maxY"] + halfY > bounds[1]
+    ):
+        return None
+    window, windowHeader = readDtmWindow(
+        fpDtm,
+        (
+            bounds[0] - header["columnSpacing"],
+            bounds[1] - header["pointSpacing"],
+            bounds[2] + header["columnSpacing"],
+            bounds[3] + header["pointSpacing"],
+        ),
+    )
+    if window.size == 0:
+        return None
+    dtm = np.full((rows, cols), np.nan)
+    reproject(
+        source=dtmToFloat(window),
+        destination=dtm,
+        src_transform=dtmTransform(windowHeader),
+        src_crs="EPSG:5070",
+        src_nodata=np.nan,
+        dst_transform=dstTransform,
+        dst_crs="EPSG:5070",
+        dst_nodata=np.nan,
+        resampling=Resampling.average,
+    )
+    return dtm
+
+
+def surfaceDerivatives(z, h, spacing):
+    # Zevenbergen and Thorne (1987) derivatives using the cells h cells away
+    # z (array) - surface; the outer h cells of the result are NaN
+    # spacing (float) - distance between the cells used (meters)
+    rows, cols = z.shape
+    out = np.full((5, rows, cols), np.nan)
+    if rows <= 2 * h or cols <= 2 * h:
+        return out
+    c = z[h:-h, h:-h]
+    north = z[: -2 * h, h:-h]
+    south = z[2 * h :, h:-h]
+    west = z[h:-h, : -2 * h]
+    east = z[h:-h, 2 * h :]
+    nw = z[: -2 * h, : -2 * h]
+    ne = z[: -2 * h, 2 * h :]
+    sw = z[2 * h :, : -2 * h]
+    se = z[2 * h :, 2 * h :]
+    D = ((west + east) / 2 - c) / spacing ** 2
+    E = ((north + south) / 2 - c) / spacing ** 2
+    F = (-nw + ne + sw - se) / (4 * spacing ** 2)
+    G = (east - west) / (2 * spacing)
+    H = (north - south) / (2 * spacing)
+    out[:, h:-h, h:-h] = np.stack([D, E, F, G, H])
+    return out
+
+
+def topoFromDerivatives(derivatives, latitude):
+    # Slope (degrees), aspect (degrees), profile and plan curvature, and SRI
+    D, E, F, G, H = derivatives
+    gradient2 = G ** 2 + H ** 2
+    slope = np.degrees(np.arctan(np.sqrt(gradient2)))
+    # downslope direction, clockwise from north
+    aspect = np.mod(np.degrees(np.arctan2(-G, -H)), 360)
+    flat = gradient2 == 0
+    with np.errstate(invalid="ignore", divide="ignore"):
+        profile = -2 * (D * G ** 2 + E * H ** 2 + F * G * H) / gradient2 * 100
+        plan = 2 * (D * H ** 2 + E * G ** 2 - F * G * H) / gradient2 * 100
+    profile[flat] = 0
+    plan[flat] = 0
+    lat = math.radians(latitude)
+    sri = 1 + math.cos(lat) * np.cos(np.radians(slope)) + math.sin(lat) * np.sin(
+        np.radians(slope)
+    ) * np.cos(np.radians(aspect - 180))
+    aspect[flat] = -1
+    return slope, aspect, profile, plan, sri
+
+
+def processTopoTile(
+    fpDtms, tileBounds, cellSize, workCellSize, windowSizes, tpiWindowSizes, latitude
+):
+    # Computes the topo metrics of one tile; used with joblib
+    # tileBounds (tuple) - tile extent (no halo) aligned to cellSize
+    # returns a dictionary of {layer name: array} covering tileBounds
+    factor = int(round(cellSize / workCellSize))
+    tileCols = int(round((tileBounds[2] - tileBounds[0]) / cellSize))
+    tileRows = int(round((tileBounds[3] - tileBounds[1]) / cellSize))
+
+    # fine surface with a halo large enough for the largest topo and TPI
+    # windows; the DTMs are only read here
+    topoHaloCells = int(math.ceil(max(list(windowSizes) + [cellSize]) / cellSize)) + 1
+    haloCells = topoHaloCells
+    if len(tpiWindowSizes) > 0:
+        haloCells = max(haloCells, int(math.ceil(max(tpiWindowSizes) / 2 / cellSize)) + 1)
+    halo = haloCells * cellSize
+    zWork = readDtmMosaic(
+        fpDtms,
+        (
+            tileBounds[0] - halo,
+            tileBounds[1] - halo,
+            tileBounds[2] + halo,
+            tileBounds[3] + halo,
+        ),
+        workCellSize,
+    )
+    # cell elevations for the single-scale metrics and TPI
+    zCell = blockMean(zWork, factor)
+    core = slice(haloCells, haloCells + tileRows), slice(
+        haloCells, haloCells + tileCols
+    )
+    # the topo windows only need their own halo
+    trim = (haloCells - topoHaloCells) * factor
+    if trim > 0:
+        zWork = zWork[trim:-trim, trim:-trim]
+    topoCore = slice(topoHaloCells, topoHaloCells + tileRows), slice(
+        topoHaloCells, topoHaloCells + tileCols
+    )
+
+    layers = {}
+    cellId = formatIdentifier(cellSize)
+    layers["elevation_" + cellId] = zCell[core]
+
+    # single-scale metrics from the neighboring cells, named like the
+    # FUSION TopoMetrics layers (DOTOPO in Basic_setup.bat)
+    derivatives = surfaceDerivatives(zCell, 1, cellSize)
+    slope, aspect, profile, plan, sri = topoFromDerivatives(derivatives, latitude)
+    curvature = -2 * (derivatives[0] + derivatives[1]) * 100
+    layers["slope_" + cellId] = slope[core]
+    layers["aspect_" + cellId] = aspect[core]
+    layers["profilecurv_" + cellId] = profile[core]
+    layers["plancurv_" + cellId] = plan[core]
+    layers["sri_" + cellId] = sri[core]
+    layers["curvature_" + cellId] = curvature[core]
+
+    for windowSize in windowSizes:
+        n = oddCells(windowSize, workCellSize)
+        h = n // 2
+        zSmooth = boxMean(zWork, n)
+        slope, aspect, profile, plan, sri = topoFromDerivatives(
+            surfaceDerivatives(zSmooth, h, h * workCellSize), latitude
+        )
+        # average aspect as a unit vector so 359 and 1 average to 0
+        aspectFlat = aspect < 0
+        aspectX = blockMean(np.where(aspectFlat, np.nan, np.sin(np.radians(aspect))), factor)
+        aspectY = blockMean(np.where(aspectFlat, np.nan, np.cos(np.radians(aspect))), factor)
+        aspectMean = np.mod(np.degrees(np.arctan2(aspectX, aspectY)), 360)
+        aspectMean[np.isnan(aspectMean) & ~np.isnan(blockMean(slope, factor))] = -1
+
+        windowId = formatIdentifier(windowSize) + "_" + cellId
+        layers["slope_degrees_" + windowId] = blockMean(slope, factor)[topoCore]
+        layers["aspect_degrees_" + windowId] = aspectMean[topoCore]
+        layers["profile_curvature_" + windowId] = blockMean(profile, factor)[topoCore]
+        layers["plan_curvature_" + windowId] = blockMean(plan, factor)[topoCore]
+        layers["solar_radiation_index_" + windowId] = blockMean(sri, factor)[topoCore]
+    del zWork
+
+    for windowSize in tpiWindowSizes:
+        tpi = zCell - boxMean(zCell, oddCells(windowSize, cellSize))
+        layers["tpi_" + formatIdentifier(windowSize) + "_" + cellId] = tpi[core]
+    return layers
+
+
+def computeTopoMetrics(
+    fpDtms,
+    outDir,
+    gridTransform,
+    gridWidth,
+    gridHeight,
+    windowSizes,
+    tpiWindowSizes,
+    latitude,
+    nCores,
+    workCellSize=5,
+    tileCells=256,
+):
+    # Computes topo metrics on a grid and writes them as TOPO_*.asc files
+    # fpDtms (list) - file paths of the ground DTMs
+    # outDir (str) - directory of the outputs (e.g., Metrics_30METERS)
+    # gridTransform, gridWidth, gridHeight - grid of the outputs; use the
+    #   grid of the FUSION metrics so the layers line up
+    # windowSizes (list) - MULTITOPOWINDOWSIZES
+    # tpiWindowSizes (list) - MULTITPIWINDOWSIZES
+    # latitude (float) - latitude used for the solar radiation index
+    # nCores (int) - number of tiles processed in parallel
+    # workCellSize (float) - resolution of the smoothed surface; must divide
+    #   the grid cell size
+    # tileCells (int) - width and height of a tile in grid cells
+    cellSize = gridTransform.a
+    xMin = gridTransform.c
+    yMax = gridTransform.f
+
+    tiles = []
+    for row in range(0, gridHeight, tileCells):
+        for col in range(0, gridWidth, tileCells):
+            nRows = min(tileCells, gridHeight - row)
+            nCols = min(tileCells, gridWidth - col)
+            tileBounds = (
+                xMin + col * cellSize,
+                yMax - (row + nRows) * cellSize,
+                xMin + (col + nCols) * cellSize,
+                yMax - row * cellSize,
+            )
+            tiles.append((row, col, tileBounds))
+
+    results = Parallel(n_jobs=max(min(nCores, len(tiles)), 1))(
+        delayed(processTopoTile)(
+            fpDtms,
+            tileBounds,
+            cellSize,
+            workCellSize,
+            windowSizes,
+            tpiWindowSizes,
+            latitude,
+        )
+        for row, col, tileBounds in tiles
+    )
+
+    # put the tiles together
+    grids = {}
+    for (row, col, tileBounds), layers in zip(tiles, results):
+        for name, values in layers.items():
+            if name not in grids:
+                grids[name] = np.full((gridHeight, gridWidth), np.nan, dtype=np.float32)
+            grids[name][
+                row : row + values.shape[0], col : col + values.shape[1]
+            ] = values
+    del results
+
+    if not os.path.exists(outDir):
+        os.mkdir(outDir)
+    kwds = {
+        "driver": "AAIGrid",
+        "width": gridWidth,
+        "height": gridHeight,
+        "count": 1,
+        "dtype": "float32",
+        "crs": "EPSG:5070",
+        "transform": gridTransform,
+        "nodata": -9999,
+    }
+    for name, values in grids.items():
+        fpOut = os.path.join(outDir, "TOPO_" + name + ".asc")
+        values[np.isnan(values)] = -9999
+        with rio.open(fpOut, "w", **kwds) as dst:
+            dst.write(values, 1)